@@ -27,8 +27,15 @@ class SystemConfig(object):
 
     # QoS Levels
     QOS_SENSOR_DATA = 1  # At least once per dati critici
+    QOS_SENSOR_TELEMETRY = 0  # Flusso letture glicemia (volatile, la lettura successiva sostituisce quella persa)
     QOS_COMMANDS = 2  # Exactly once per comandi
     QOS_NOTIFICATIONS = 1  # At least once per notifiche
+    # QoS delle notifiche in base alla gravità (le informative non attendono il PUBACK)
+    NOTIFICATION_QOS_BY_SEVERITY = {"low": 0, "medium": 0, "high": 1, "critical": 1}
+
+    # Formato payload SenML: JSON (default) o CBOR binario (RFC 8428 §6, richiede cbor2).
+    # I ricevitori riconoscono automaticamente entrambi i formati.
+    SENML_CBOR_ENABLED = False
 
     # Retained Messages
     RETAIN_PATIENT_INFO = True
@@ -38,7 +45,31 @@ class SystemConfig(object):
     # Intervalli di Tempo (secondi)
     # ---------------------------------------------------------------------
     GLUCOSE_READING_INTERVAL = 10  # Ogni 5 secondi (CGM realistico: 1-5 min)
+    # Letture del sensore raggruppate in un unico pacchetto SenML (1 = pubblicazione a ogni lettura).
+    # Valori > 1 ritardano fino a (N-1) intervalli le decisioni del Data Collector
+    SENSOR_BATCH_SIZE = 1
+    # Publish-on-change: letture con stesso stato e trend e valore entro SENSOR_DEDUPE_EPSILON (mg/dL)
+    # dall'ultimo pubblicato non vengono ripubblicate, salvo un heartbeat dopo SENSOR_HEARTBEAT_READINGS
+    # letture saltate e i valori critici (sempre pubblicati); attivabile anche con --dedupe
+    SENSOR_DEDUPE_ENABLED = False
+    SENSOR_DEDUPE_EPSILON = 0.5
+    SENSOR_HEARTBEAT_READINGS = 6
+    # Coda di pubblicazione del sensore: se il broker rallenta si scartano le letture più vecchie
+    SENSOR_TX_QUEUE_SIZE = 1024
+    # Ogni quante letture pubblicate il sensore aggiorna lo stato retained su /glucose/sensor/state
+    SENSOR_STATE_EVERY_READINGS = 6
+    # Scadenza (MQTT v5 Message Expiry Interval) delle letture pubblicate dal sensore:
+    # il broker scarta quelle non ancora consegnate invece di accumularle per i client offline
+    SENSOR_MESSAGE_EXPIRY_S = 300
+    # Ritardo (in intervalli di lettura) oltre il quale il ciclo del sensore si riallinea invece di recuperare
+    SENSOR_MAX_LAG_INTERVALS = 2
+    # Multi sensor runner: sensori ripartiti in N gruppi pubblicati a distanza di intervallo/N
+    # (evita che tutte le letture arrivino al broker nello stesso istante)
+    MULTI_SENSOR_SLOTS = 10
     PUMP_STATUS_INTERVAL = 30  # Status pompa ogni 30 secondi
+    # Status pompa ripubblicato solo se cambia (serbatoio/batteria arrotondati all'unità, stato, allarmi,
+    # basale), con un refresh completo del retained almeno ogni N intervalli
+    PUMP_STATUS_REFRESH_EVERY = 10
     INSULIN_ACTION_DURATION_SECONDS = 60 #durata azione insulina
 
     # ---------------------------------------------------------------------
@@ -63,6 +94,8 @@ class SystemConfig(object):
     SENSOR_BATTERY_DRAIN_MAX = 0.2
     SENSOR_SIGNAL_MIN_DBM = -60
     SENSOR_SIGNAL_MAX_DBM = -40
+    # Batteria e segnale aggiornati ogni N letture (scarico scalato di N, 1 = a ogni lettura)
+    SENSOR_AUX_UPDATE_EVERY = 10
 
     # Soglia per definire un trend "in salita/discesa" (mg/dL per intervallo)
     SENSOR_TREND_THRESHOLD = 3.0
@@ -78,6 +111,9 @@ class SystemConfig(object):
     PUMP_ALARM_LOW_BATTERY_PCT = 15.0  # Soglia avviso batteria bassa (%)
     PUMP_ALARM_CRITICAL_BATTERY_PCT = 5.0  # Soglia critica batteria (%)
 
+    PUMP_COMMAND_HISTORY_LIMIT = 256  # Ultimi comandi eseguiti conservati in memoria dalla pompa
+    PUMP_DELIVERY_QUEUE_SIZE = 16  # Erogazioni in attesa oltre le quali la pompa rifiuta i comandi (occupata)
+
     # ---------------------------------------------------------------------
     # Parametri di Sicurezza
     # ---------------------------------------------------------------------
@@ -85,6 +121,21 @@ class SystemConfig(object):
     SAFETY_MAX_BASAL_RATE_UH = 5.0  # Unità/ora massime per basale
     SAFETY_MIN_CORRECTION_INTERVAL_S = 180  # 3 minuti
 
+    # Finestra entro cui una notifica con stesso livello/gravità non viene ripubblicata
+    NOTIFICATION_DEDUP_WINDOW_S = 60
+
+    # Notifiche di bassa gravità raccolte e pubblicate in un unico pacchetto SenML periodico
+    NOTIFICATION_DIGEST_SEVERITIES = ("low", "medium")
+    NOTIFICATION_DIGEST_INTERVAL_S = 5
+
+    # Storici in memoria del Data Collector (code circolari)
+    COLLECTOR_ALERT_HISTORY_LIMIT = 10  # Ultime notifiche conservate
+    COLLECTOR_COMMAND_LOG_LIMIT = 256  # Ultimi comandi insulina conservati
+
+    # Letture glicemia più vecchie di così (es. backlog dopo una riconnessione)
+    # aggiornano solo lo stato del Data Collector senza generare dosi o alert
+    COLLECTOR_MAX_READING_AGE_S = 3 * GLUCOSE_READING_INTERVAL
+
     # ---------------------------------------------------------------------
     # Parametri di Simulazione
     # ---------------------------------------------------------------------
@@ -125,6 +176,21 @@ class SystemConfig(object):
     # ---------------------------------------------------------------------
     MQTT_KEEPALIVE_S = 60
     MQTT_TIMEOUT_S = 60
+    # TCP_NODELAY sul socket MQTT: evita i ~40 ms di Nagle/delayed ACK tra publish ravvicinati
+    # (per l'effetto completo anche il broker deve abilitarlo, es. Mosquitto: set_tcp_nodelay true)
+    MQTT_TCP_NODELAY = True
+    MQTT_PUBLISH_TIMEOUT_S = 5  # Attesa massima conferma publish QoS>0 nel thread writer
+    # Publish QoS>0 in volo senza attendere la conferma (default paho: 20)
+    MQTT_MAX_INFLIGHT_MESSAGES = 64
+
+    # Livello di log del Data Collector (dettagli per lettura a DEBUG, azioni e alert a INFO/WARNING)
+    COLLECTOR_LOG_LEVEL = "INFO"
+    # Livello di log del sensore glicemia (--quiet porta a WARNING: solo valori critici ed errori)
+    SENSOR_LOG_LEVEL = "INFO"
+    # Livello di log della pompa (comandi ricevuti/eseguiti a INFO, dettagli erogazione a DEBUG)
+    PUMP_LOG_LEVEL = "INFO"
+    # Con --ring-log il sensore tiene in memoria gli ultimi N messaggi e li stampa solo all'arresto
+    SENSOR_RING_LOG_SIZE = 256
 
     # ---------------------------------------------------------------------
     # Parametri Simulazione (Processi)
@@ -6,7 +6,10 @@ import os
 import json
 import time
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from conf.SystemConfiguration import SystemConfig as Config
 from utils.senml_helper import SenMLHelper
 from model.patient_descriptor import PatientDescriptor
@@ -56,49 +59,51 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     """Gestisce e aggiorna i dati in base al topic ricevuto."""
     try:
-        payload = msg.payload.decode()
-        parsed = SenMLHelper.parse_senml(payload)
-        measurements = parsed.get("measurements", {})
-        timestamp = time.strftime('%H:%M:%S', time.localtime(parsed.get("base_time")))
-
         with data_lock:
-            # Dati Sensore Glicemia
+            # Dati Sensore Glicemia (un pacchetto può contenere più letture)
             if "glucose/sensor/data" in msg.topic:
-                glucose = measurements.get("level", {}).get("value")
-                status = measurements.get("status", {}).get("value")
-                trend = measurements.get("trend", {}).get("value")
-                trend_rate = measurements.get("trend_rate", {}).get("value", 0.0)
-                battery = measurements.get("battery", {}).get("value")
-
-                # Aggiornamento dati correnti
-                current_data['glucose_value'] = round(glucose, 1)
-                current_data['glucose_status'] = status
-                current_data['sensor_battery'] = round(battery, 1)
-                current_data['glucose_trend'] = trend.capitalize()
-                current_data['trend_rate'] = round(trend_rate, 1)
-
-                # Aggiungi alla cronologia per il grafico
-                glucose_history.append({'time': timestamp, 'value': round(glucose, 1)})
-                if len(glucose_history) > Config.DASHBOARD_HISTORY_LIMIT:
-                    glucose_history.pop(0)
+                for parsed in SenMLHelper.parse_senml_pack(msg.payload):
+                    measurements = parsed.get("measurements", {})
+                    timestamp = time.strftime('%H:%M:%S', time.localtime(parsed.get("base_time")))
+                    glucose = measurements.get("level")
+                    status = measurements.get("status")
+                    trend = measurements.get("trend")
+                    trend_rate = measurements.get("trend_rate", 0.0)
+                    battery = measurements.get("battery")
+
+                    # Aggiornamento dati correnti
+                    current_data['glucose_value'] = round(glucose, 1)
+                    current_data['glucose_status'] = status
+                    current_data['sensor_battery'] = round(battery, 1)
+                    current_data['glucose_trend'] = trend.capitalize()
+                    current_data['trend_rate'] = round(trend_rate, 1)
+
+                    # Aggiungi alla cronologia per il grafico
+                    glucose_history.append({'time': timestamp, 'value': round(glucose, 1)})
+                    if len(glucose_history) > Config.DASHBOARD_HISTORY_LIMIT:
+                        glucose_history.pop(0)
 
             # Dati Status Pompa
             elif "insulin/pump/status" in msg.topic:
-                current_data['pump_status'] = measurements.get("status", {}).get("value")
-                current_data['insulin_reservoir'] = round(measurements.get("reservoir", {}).get("value", 0), 1)
-                current_data['battery_level'] = round(measurements.get("battery", {}).get("value", 0), 1)
-                current_data['alarms_count'] = measurements.get("alarms_count", {}).get("value", 0)
+                measurements = SenMLHelper.parse_senml(msg.payload).get("measurements", {})
+                current_data['pump_status'] = measurements.get("status")
+                current_data['insulin_reservoir'] = round(measurements.get("reservoir", 0), 1)
+                current_data['battery_level'] = round(measurements.get("battery", 0), 1)
+                current_data['alarms_count'] = measurements.get("alarms_count", 0)
 
             # Alert/Notifiche
             elif "notifications/alert" in msg.topic:
-                alert_log.append({
-                    'time': timestamp,
-                    'type': measurements.get("type", {}).get("value"),
-                    'message': measurements.get("message", {}).get("value"),
-                    'severity': measurements.get("severity", {}).get("value")
-                })
-                if len(alert_log) > Config.DASHBOARD_ALERT_LIMIT:
-                    alert_log.pop(0)
+                # Un pacchetto può contenere più alert concatenati
+                for alert in SenMLHelper.parse_senml_pack(msg.payload):
+                    alert_measurements = alert.get("measurements", {})
+                    alert_log.append({
+                        'time': time.strftime('%H:%M:%S', time.localtime(alert.get("base_time"))),
+                        'type': alert_measurements.get("type"),
+                        'message': alert_measurements.get("message"),
+                        'severity': alert_measurements.get("severity")
+                    })
+                    if len(alert_log) > Config.DASHBOARD_ALERT_LIMIT:
+                        alert_log.pop(0)
 
     except Exception as e:
         print(f"❌ Errore nel processare messaggio MQTT: {e}")
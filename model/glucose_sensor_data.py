@@ -5,6 +5,16 @@ from utils.senml_helper import SenMLHelper
 from conf.SystemConfiguration import SystemConfig as Config
 
 class GlucoseSensorData:
+    # Attributi fissi: niente __dict__ per istanza (più compatta con molti sensori nello stesso processo)
+    __slots__ = (
+        "sensor_id", "patient_id",
+        "glucose_value", "glucose_status",
+        "sensor_status", "battery_level", "signal_strength", "_aux_every", "_aux_countdown",
+        "timestamp",
+        "trend_direction", "trend_rate", "_rate_interval", "_rate_scale",
+        "confidence_level", "calibration_needed",
+    )
+
     def __init__(self, sensor_id, patient_id, glucose_value=None, initial_battery=None):
 
         # Identificazione
@@ -27,6 +37,9 @@ class GlucoseSensorData:
 
         # Segnale iniziale (valore medio)
         self.signal_strength = int((Config.SENSOR_SIGNAL_MIN_DBM + Config.SENSOR_SIGNAL_MAX_DBM) / 2)
+        # Letture mancanti al prossimo aggiornamento di batteria e segnale
+        self._aux_every = Config.SENSOR_AUX_UPDATE_EVERY
+        self._aux_countdown = self._aux_every
 
         # Timestamp
         self.timestamp = int(time.time())
@@ -34,6 +47,8 @@ class GlucoseSensorData:
         # Trend
         self.trend_direction = "stable"
         self.trend_rate = 0.0  # mg/dL/min
+        self._rate_interval = None
+        self._rate_scale = 0.0
 
         # Qualità del dato
         self.confidence_level = 1.0
@@ -52,10 +67,12 @@ class GlucoseSensorData:
         else:
             return "normal"
 
-    def apply_variation(self, variation: float, reading_interval: float):
+    def apply_variation(self, variation: float, reading_interval: float, rng: random.Random = None,
+                        now: float = None):
         """
         Applica una variazione di glicemia e aggiorna TUTTI
         i parametri del sensore in modo coerente.
+        now: istante della lettura già letto dal chiamante (default time.time()).
         """
 
         new_value = self.glucose_value + variation
@@ -64,26 +81,38 @@ class GlucoseSensorData:
         # Stato glicemico
         self.glucose_status = self._determine_glucose_status(self.glucose_value)
 
-        # Calcolo del trend
-        if variation > Config.SENSOR_TREND_THRESHOLD:
+        # Calcolo del trend (mg/dL/min): fattore di scala ricalcolato solo se cambia l'intervallo
+        if reading_interval != self._rate_interval:
+            self._rate_interval = reading_interval
+            self._rate_scale = 60.0 / reading_interval
+        threshold = Config.SENSOR_TREND_THRESHOLD
+        if variation > threshold:
             self.trend_direction = "rising"
-            self.trend_rate = abs(variation) / (reading_interval / 60.0)
-        elif variation < -Config.SENSOR_TREND_THRESHOLD:
+            self.trend_rate = variation * self._rate_scale
+        elif variation < -threshold:
             self.trend_direction = "falling"
-            self.trend_rate = abs(variation) / (reading_interval / 60.0)
+            self.trend_rate = -variation * self._rate_scale
         else:
             self.trend_direction = "stable"
             self.trend_rate = 0.0
 
-        # Degradazione batteria
-        drain = random.uniform(Config.SENSOR_BATTERY_DRAIN_MIN, Config.SENSOR_BATTERY_DRAIN_MAX)
-        self.battery_level = max(0.0, self.battery_level - drain)
+        # Batteria e segnale variano poco tra una lettura e l'altra: aggiornati ogni
+        # _aux_every letture con uno scarico pari a _aux_every estrazioni medie
+        self._aux_countdown -= 1
+        if self._aux_countdown <= 0:
+            self._aux_countdown = self._aux_every
+            u = (rng or random).random
+
+            # Degradazione batteria
+            drain = Config.SENSOR_BATTERY_DRAIN_MIN + (Config.SENSOR_BATTERY_DRAIN_MAX - Config.SENSOR_BATTERY_DRAIN_MIN) * u()
+            self.battery_level = max(0.0, self.battery_level - drain * self._aux_every)
 
-        # Qualità segnale
-        self.signal_strength = random.randint(Config.SENSOR_SIGNAL_MIN_DBM, Config.SENSOR_SIGNAL_MAX_DBM)
+            # Qualità segnale
+            self.signal_strength = Config.SENSOR_SIGNAL_MIN_DBM + int(
+                (Config.SENSOR_SIGNAL_MAX_DBM - Config.SENSOR_SIGNAL_MIN_DBM + 1) * u())
 
         # Timestamp aggiornato
-        self.timestamp = int(time.time())
+        self.timestamp = int(now if now is not None else time.time())
 
     # METODI DI UTILITÀ
     def is_critical(self):
@@ -111,10 +140,14 @@ class GlucoseSensorData:
             return "NORMAL"
 
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__)
+        # Solo i campi pubblici: lo stato interno (_aux_*, _rate_*) non fa parte della lettura
+        return json.dumps({name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")})
 
     def to_senml(self):
-        return SenMLHelper.create_glucose_sensor_full_data(
+        return SenMLHelper.encode_senml(self.to_senml_records())
+
+    def to_senml_records(self):
+        return SenMLHelper.glucose_sensor_records(
             patient_id=self.patient_id,
             sensor_id=self.sensor_id,
             glucose_value=self.glucose_value,
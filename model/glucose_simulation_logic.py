@@ -1,29 +1,62 @@
 import random
 
 from conf.SystemConfiguration import SystemConfig as Config
-class GlucoseSimulationLogic:
 
-    @staticmethod
-    def generate_variation(current_value: float, simulation_mode: str) -> float:
-        if simulation_mode == "normal": #random walk
-            return random.uniform(Config.SIM_NORMAL_MIN, Config.SIM_NORMAL_MAX)
+# Generatore privato usato quando il chiamante non passa la propria istanza
+_rng = random.Random()
+
+
+# Variazione naturale per modalità di simulazione: u è il random() del generatore da usare.
+# Le estrazioni sono a + (b - a) * u() invece di random.uniform.
+def _variation_normal(u) -> float: #random walk
+    return Config.SIM_NORMAL_MIN + (Config.SIM_NORMAL_MAX - Config.SIM_NORMAL_MIN) * u()
+
+
+def _variation_hypoglycemia(u) -> float:
+    if u() < Config.SIM_HYPO_UP_PROBABILITY: # Possibile piccolo rialzo
+        return Config.SIM_HYPO_UP_MIN + (Config.SIM_HYPO_UP_MAX - Config.SIM_HYPO_UP_MIN) * u()
+    return Config.SIM_HYPO_DOWN_MIN + (Config.SIM_HYPO_DOWN_MAX - Config.SIM_HYPO_DOWN_MIN) * u()
 
-        elif simulation_mode == "hypoglycemia":
-            v = random.uniform(Config.SIM_HYPO_DOWN_MIN, Config.SIM_HYPO_DOWN_MAX)
-            if random.random() < Config.SIM_HYPO_UP_PROBABILITY: # Possibile piccolo rialzo
-                v = random.uniform(Config.SIM_HYPO_UP_MIN, Config.SIM_HYPO_UP_MAX)
-            return v
 
-        elif simulation_mode == "hyperglycemia":
-            v = random.uniform(Config.SIM_HYPER_UP_MIN, Config.SIM_HYPER_UP_MAX)
-            if random.random() < Config.SIM_HYPER_DOWN_PROBABILITY: # Possibile piccolo ribasso
-                v = random.uniform(Config.SIM_HYPER_DOWN_MIN, Config.SIM_HYPER_DOWN_MAX)
-            return v
+def _variation_hyperglycemia(u) -> float:
+    if u() < Config.SIM_HYPER_DOWN_PROBABILITY: # Possibile piccolo ribasso
+        return Config.SIM_HYPER_DOWN_MIN + (Config.SIM_HYPER_DOWN_MAX - Config.SIM_HYPER_DOWN_MIN) * u()
+    return Config.SIM_HYPER_UP_MIN + (Config.SIM_HYPER_UP_MAX - Config.SIM_HYPER_UP_MIN) * u()
 
-        elif simulation_mode == "fluctuating":
-            return random.uniform(Config.SIM_FLUCTUATING_MIN, Config.SIM_FLUCTUATING_MAX)
 
-        return random.uniform(Config.SIM_FALLBACK_MIN, Config.SIM_FALLBACK_MAX)
+def _variation_fluctuating(u) -> float:
+    return Config.SIM_FLUCTUATING_MIN + (Config.SIM_FLUCTUATING_MAX - Config.SIM_FLUCTUATING_MIN) * u()
+
+
+def _variation_fallback(u) -> float:
+    return Config.SIM_FALLBACK_MIN + (Config.SIM_FALLBACK_MAX - Config.SIM_FALLBACK_MIN) * u()
+
+
+_VARIATION_BY_MODE = {
+    "normal": _variation_normal,
+    "hypoglycemia": _variation_hypoglycemia,
+    "hyperglycemia": _variation_hyperglycemia,
+    "fluctuating": _variation_fluctuating,
+}
+
+
+class GlucoseSimulationLogic:
+
+    @staticmethod
+    def variation_for_mode(simulation_mode: str):
+        """
+        Restituisce la funzione di variazione della modalità, da selezionare una volta
+        (all'avvio o al cambio modalità) e chiamare a ogni lettura con rng.random.
+        """
+        return _VARIATION_BY_MODE.get(simulation_mode, _variation_fallback)
+
+    @staticmethod
+    def generate_variation(current_value: float, simulation_mode: str, rng: random.Random = None) -> float:
+        """
+        Genera la variazione naturale di glicemia per la modalità di simulazione.
+        Usa rng (istanza privata del chiamante) se fornito, altrimenti il generatore del modulo.
+        """
+        return GlucoseSimulationLogic.variation_for_mode(simulation_mode)((rng or _rng).random)
 
     @staticmethod
     def calculate_insulin_effect(active_insulin_doses: list, isf: float, current_time: float,
@@ -32,7 +65,8 @@ class GlucoseSimulationLogic:
         Calcola l'effetto di abbassamento della glicemia dovuto all'insulina attiva.
 
         Args:
-            active_insulin_doses: Lista di {'amount': X, 'start_time': Y}
+            active_insulin_doses: Lista di {'amount': X, 'start_time': Y} in ordine di start_time;
+                le dosi scadute vengono rimosse dalla testa della lista
             isf: Fattore di Sensibilità all'Insulina (mg/dL per Unità)
             current_time: Tempo corrente
             reading_interval: Intervallo di lettura in secondi
@@ -41,22 +75,20 @@ class GlucoseSimulationLogic:
             La variazione negativa di glicemia (mg/dL) da applicare.
         """
         insulin_duration = Config.INSULIN_ACTION_DURATION_SECONDS
-        total_effect = 0.0
-        new_active_doses = []
 
+        # Le dosi sono accodate in ordine di arrivo: quelle scadute ("dimenticate") sono tutte in testa
+        expired = 0
         for dose in active_insulin_doses:
-            elapsed = current_time - dose['start_time']
-
-            if elapsed < insulin_duration:
-                # Calcoliamo la riduzione potenziale in mg/dL per l'intero bolo
-                total_glucose_reduction = dose['amount'] * isf
-                reduction_per_interval = total_glucose_reduction * (reading_interval / insulin_duration)
-
-                total_effect -= reduction_per_interval
-                new_active_doses.append(dose)
-            # Se elapsed >= insulin_duration, la dose viene "dimenticata"
+            if current_time - dose['start_time'] < insulin_duration:
+                break
+            expired += 1
+        if expired:
+            del active_insulin_doses[:expired]
 
-        active_insulin_doses[:] = new_active_doses
+        # Ogni dose attiva riduce la glicemia della stessa quota per intervallo
+        # (riduzione totale amount * isf distribuita sulla durata d'azione)
+        active_units = sum(dose['amount'] for dose in active_insulin_doses)
+        total_effect = -active_units * isf * (reading_interval / insulin_duration)
 
         # Limita la riduzione per evitare crolli improvvisi (safety guard interna)
         return max(-30.0, total_effect)
\ No newline at end of file
@@ -4,6 +4,9 @@ import uuid
 from utils.senml_helper import SenMLHelper
 from conf.SystemConfiguration import SystemConfig as Config
 
+# Allarmi che richiedono l'invio di un alert critico
+CRITICAL_ALARMS = frozenset(("insulin_empty", "battery_critical", "pump_error"))
+
 class InsulinPumpCommand:
     def __init__(self, pump_id, patient_id, delivery_mode, insulin_amount,
                  delivery_rate=None, priority="normal", reason=None):
@@ -75,13 +78,16 @@ class InsulinPumpStatus:
         self.last_bolus_time = None
         self.total_daily_insulin = 0.0
 
-        # Allarmi e errori
-        self.active_alarms = []
+        # Allarmi e errori (tupla ricostruita da _check_alarms: confrontabile e riusabile senza copie)
+        self.active_alarms = ()
         self.last_error = None
 
         # Timestamp
         self.timestamp = int(time.time())
 
+        # Record SenML dello status riutilizzati tra una pubblicazione e l'altra (vedi to_senml)
+        self._senml_records = None
+
     def update_status(self):
         seconds_elapsed = Config.PUMP_STATUS_INTERVAL
         consumption_per_interval = self.current_basal_rate * (seconds_elapsed / 3600.0)
@@ -98,19 +104,27 @@ class InsulinPumpStatus:
         self.timestamp = int(time.time())
 
     def _check_alarms(self):
-        self.active_alarms = []
+        alarms = []
         if self.insulin_percentage() < Config.PUMP_ALARM_LOW_INSULIN_PCT:
-            self.active_alarms.append("low_insulin")
+            alarms.append("low_insulin")
 
         if self.battery_level < Config.PUMP_ALARM_LOW_BATTERY_PCT:
-            self.active_alarms.append("low_battery")
+            alarms.append("low_battery")
 
         if self.insulin_reservoir_level <= 0:
-            self.active_alarms.append("insulin_empty")
+            alarms.append("insulin_empty")
             self.pump_status = "inactive"
 
         if self.battery_level <= Config.PUMP_ALARM_CRITICAL_BATTERY_PCT:
-            self.active_alarms.append("battery_critical")
+            alarms.append("battery_critical")
+
+        # Nel caso comune (nessun cambiamento) si conserva la tupla precedente
+        if alarms:
+            alarms = tuple(alarms)
+            if alarms != self.active_alarms:
+                self.active_alarms = alarms
+        elif self.active_alarms:
+            self.active_alarms = ()
 
     def deliver_bolus(self, amount, bolus_type="correction"):
         if self.insulin_reservoir_level >= amount and self.pump_status == "active":
@@ -137,17 +151,25 @@ class InsulinPumpStatus:
         return self.battery_level < threshold
 
     def has_critical_alarms(self):
-        critical_alarms = ["insulin_empty", "battery_critical", "pump_error"]
-        return any(alarm in self.active_alarms for alarm in critical_alarms)
+        return not CRITICAL_ALARMS.isdisjoint(self.active_alarms)
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__)
 
     def to_senml(self):
-        return SenMLHelper.create_pump_status(
-            patient_id=self.patient_id,
-            reservoir_level=self.insulin_reservoir_level,
-            battery_level=self.battery_level,
-            status=self.pump_status,
-            timestamp=self.timestamp
-        )
\ No newline at end of file
+        """Payload SenML dello status: i record sono allocati alla prima chiamata e poi aggiornati in place"""
+        records = self._senml_records
+        if records is None:
+            records = self._senml_records = SenMLHelper.pump_status_records(
+                patient_id=self.patient_id,
+                reservoir_level=self.insulin_reservoir_level,
+                battery_level=self.battery_level,
+                status=self.pump_status,
+                timestamp=self.timestamp
+            )
+        else:
+            records[0]["bt"] = self.timestamp
+            records[1]["v"] = self.insulin_reservoir_level
+            records[2]["v"] = self.battery_level
+            records[3]["vs"] = self.pump_status
+        return SenMLHelper.encode_senml(records)
\ No newline at end of file
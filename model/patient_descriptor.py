@@ -1,5 +1,6 @@
 import json
 import time
+from utils.senml_helper import SenMLHelper
 
 class PatientDescriptor:
     def __init__(self, patient_id, name, age, weight,
@@ -59,7 +60,7 @@ class PatientDescriptor:
         timestamp = self.last_updated
 
         base_name = f"urn:patient:{self.patient_id}:descriptor:"
-        return json.dumps([
+        return SenMLHelper.encode_senml([
             {"bn": base_name, "bt": timestamp},
             {"n": "target_glucose_min", "v": self.target_glucose_min},
             {"n": "target_glucose_max", "v": self.target_glucose_max},
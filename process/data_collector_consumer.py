@@ -4,11 +4,23 @@ import time
 import sys
 import os
 import uuid
-
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import queue
+import logging
+import threading
+from collections import deque
+
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from model.patient_descriptor import PatientDescriptor
 from conf.SystemConfiguration import SystemConfig as Config
-from utils.senml_helper import SenMLHelper
+from utils.senml_helper import SenMLHelper, GlucoseReading, ORJSON_AVAILABLE
+from utils.mqtt_socket import enable_tcp_nodelay
+
+SEVERITY_EMOJI = {"low": "ℹ️", "medium": "⚠️", "high": "🔶", "critical": "🚨"}
+NO_ALARMS = frozenset()
+
 
 class DataCollectorConsumerSenML:
     """
@@ -19,15 +31,19 @@ class DataCollectorConsumerSenML:
     - Genera notifiche in formato SenML
     """
     INSULIN_DURATION_SECONDS = Config.INSULIN_ACTION_DURATION_SECONDS
+    INV_INSULIN_DURATION = 1.0 / INSULIN_DURATION_SECONDS
 
     def __init__(self, patient_id, patient_descriptor):
         self.patient_id = patient_id
         self.patient = patient_descriptor
+        self.log = logging.getLogger("data_collector")
 
         # Configurazione MQTT
         self.broker_address = Config.BROKER_ADDRESS
         self.broker_port = Config.BROKER_PORT
-        self.client = mqtt.Client(f"data_collector_senml_{patient_id}")
+        # Sessione persistente con client id stabile: il broker conserva le sottoscrizioni
+        # (e i messaggi QoS>0) tra una riconnessione e l'altra
+        self.client = mqtt.Client(f"data_collector_senml_{patient_id}", clean_session=False)
 
         # Topic MQTT
         self.base_topic = f"/iot/patient/{patient_id}"
@@ -36,33 +52,119 @@ class DataCollectorConsumerSenML:
         self.pump_status_topic = f"{self.base_topic}/insulin/pump/status"
         self.alert_topic = f"{self.base_topic}/notifications/alert"
 
+        # Senza orjson (e in JSON): comando e alert già serializzati, per ogni messaggio si
+        # formattano solo i campi variabili; con orjson o CBOR si codificano i record SenML
+        self._command_template = None
+        self._alert_template = None
+        if not ORJSON_AVAILABLE and not Config.SENML_CBOR_ENABLED:
+            command_base_name = json.dumps(f"urn:patient:{patient_id}:insulin:command:").replace("%", "%%")
+            self._command_template = (
+                '[{"bn":' + command_base_name + ',"bt":%r},'
+                '{"n":"dose","v":%r,"u":"U","t":0},'
+                '{"n":"type","vs":%s,"t":0},'
+                '{"n":"command_id","vs":"%s","t":0},'
+                '{"n":"priority","vs":%s,"t":0},'
+                '{"n":"reason","vs":%s,"t":0}]'
+            ).encode()
+
+            # Alert: record senza parentesi, concatenabili in un pacchetto
+            alert_base_name = json.dumps(f"urn:patient:{patient_id}:alert:").replace("%", "%%")
+            self._alert_template = (
+                '{"bn":' + alert_base_name + ',"bt":%r},'
+                '{"n":"type","vs":%s,"t":0},'
+                '{"n":"message","vs":%s,"t":0},'
+                '{"n":"severity","vs":%s,"t":0}'
+            ).encode()
+
+        # Record del comando per orjson/CBOR: allocati una volta, aggiornati in place
+        self._command_records = [
+            {"bn": f"urn:patient:{patient_id}:insulin:command:", "bt": 0.0},
+            {"n": "dose", "v": 0.0, "u": "U", "t": 0},
+            {"n": "type", "vs": "", "t": 0},
+            {"n": "command_id", "vs": "", "t": 0},
+            {"n": "priority", "vs": "", "t": 0},
+            {"n": "reason", "vs": "", "t": 0}
+        ]
+
         # Stato interno
         self.last_glucose_reading = None
         self.last_pump_status = None
-        self.alert_history = []
-        self.insulin_commands_sent = []
+        self.alert_history = deque(maxlen=Config.COLLECTOR_ALERT_HISTORY_LIMIT)
+        self.insulin_commands_sent = deque(maxlen=Config.COLLECTOR_COMMAND_LOG_LIMIT)
+
+        # Totali cumulativi (lo storico comandi è limitato)
+        self._total_commands = 0
+        self._total_insulin = 0.0
+
+        # Accumulatori IOB: dosi attive (timestamp, unità) in ordine di invio,
+        # con somma delle unità e somma pesata unità*timestamp mantenute incrementalmente
+        self._active_doses = deque()
+        self._iob_units_sum = 0.0
+        self._iob_weighted_sum = 0.0
 
         # Configurazione callbacks
+        self.client.on_socket_open = enable_tcp_nodelay
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
 
+        # Coda di pubblicazione: i callback MQTT accodano (topic, payload, qos, retain)
+        # e un unico thread writer esegue publish, senza bloccare il loop di rete
+        self._tx_queue = queue.SimpleQueue()
+        self._tx_thread = threading.Thread(target=self._tx_worker, name="data_collector_tx", daemon=True)
+        self._stop_event = threading.Event()
+
+        # Digest delle notifiche poco gravi, svuotato periodicamente dal thread writer
+        self._digest_alerts = []
+        self._digest_lock = threading.Lock()
+        self._digest_severities = frozenset(Config.NOTIFICATION_DIGEST_SEVERITIES)
+        self._digest_interval = Config.NOTIFICATION_DIGEST_INTERVAL_S
+
         # Safety limits
         self.max_bolus_dose = Config.SAFETY_MAX_BOLUS_U
         self.min_time_between_corrections = Config.SAFETY_MIN_CORRECTION_INTERVAL_S
         self.last_correction_time = time.time() - Config.SAFETY_MIN_CORRECTION_INTERVAL_S
+
+        # Soglie e QoS usate per ogni messaggio, lette una sola volta dalla configurazione
+        self._crit_low = Config.GLUCOSE_CRITICAL_LOW
+        self._crit_high = Config.GLUCOSE_CRITICAL_HIGH
+        self._max_reading_age = Config.COLLECTOR_MAX_READING_AGE_S
+        self._dedup_window = Config.NOTIFICATION_DEDUP_WINDOW_S
+        self._qos_cmd = Config.QOS_COMMANDS
+        self._qos_notif = Config.QOS_NOTIFICATIONS
+        self._qos_by_severity = Config.NOTIFICATION_QOS_BY_SEVERITY
+
+        # Range "normale" per il percorso rapido: target del paziente, mai sotto la soglia di ipoglicemia
+        self._normal_low = max(patient_descriptor.target_glucose_min, patient_descriptor.hypoglycemia_threshold)
+        self._normal_high = patient_descriptor.target_glucose_max
+        self._target_glucose = (patient_descriptor.target_glucose_min + patient_descriptor.target_glucose_max) / 2
         self.waiting_notification_sent = False
 
+        # Memoization ultima notifica (evita ripubblicazioni identiche)
+        self._last_alert = None
+        self._last_alert_t = 0.0
+
+        # Notifiche accumulate durante l'elaborazione di una lettura (None = invio immediato)
+        self._pending_alerts = None
+
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             print(f"✅ Data Collector (SenML) connesso al broker MQTT")
-            print(f"📡 Subscribing a topic glicemia: {self.glucose_data_topic}")
-            print(f"📡 Subscribing a topic status pompa: {self.pump_status_topic}")
+
+            if flags.get("session present"):
+                # Sessione ripristinata dal broker: le sottoscrizioni sono ancora attive
+                print("📡 Sessione persistente ripristinata, sottoscrizioni già attive")
+            else:
+                print(f"📡 Subscribing a topic glicemia: {self.glucose_data_topic}")
+                print(f"📡 Subscribing a topic status pompa: {self.pump_status_topic}")
+
+                # Un solo pacchetto SUBSCRIBE per entrambi i topic
+                client.subscribe([
+                    (self.glucose_data_topic, Config.QOS_SENSOR_DATA),
+                    (self.pump_status_topic, Config.QOS_SENSOR_DATA)
+                ])
             print(f"Formato: SenML (RFC 8428)")
             print("=" * 60)
 
-            client.subscribe(self.glucose_data_topic, qos=Config.QOS_SENSOR_DATA)
-            client.subscribe(self.pump_status_topic, qos=Config.QOS_SENSOR_DATA)
-
             self.publish_patient_info()
 
             print("Data Collector pronto per ricevere dati SenML...")
@@ -72,59 +174,145 @@ class DataCollectorConsumerSenML:
     def on_message(self, client, userdata, msg):
         try:
             topic = msg.topic
-            payload = msg.payload.decode()
-            parsed = SenMLHelper.parse_senml(payload)
-            measurements = parsed.get("measurements", {})
+            now = time.time()  # Un solo timestamp per tutta la catena di elaborazione
 
-            # Gestione messaggi dal sensore glicemia
+            # Gestione messaggi dal sensore glicemia (un pacchetto può contenere più letture)
             if "glucose/sensor/data" in topic:
-                self.process_glucose_data(measurements, parsed.get("base_time"))
+                # Le notifiche generate dal pacchetto escono in un unico pacchetto SenML
+                self._pending_alerts = []
+                try:
+                    for parsed in SenMLHelper.parse_senml_pack(msg.payload):
+                        self.handle_glucose_reading(parsed, now)
+                finally:
+                    self.flush_notifications()
 
             # Gestione status pompa insulina
             elif "insulin/pump/status" in topic:
-                self.process_pump_status(measurements, parsed.get("base_time"))
+                parsed = SenMLHelper.parse_senml(msg.payload)
+                self.process_pump_status(parsed.get("measurements", {}), parsed.get("base_time"), now)
 
         except Exception as e:
-            print(f"❌ Errore nell'elaborazione del messaggio SenML: {e}")
+            self.log.error("❌ Errore nell'elaborazione del messaggio SenML: %s", e)
+
+    def handle_glucose_reading(self, parsed, now):
+        """Elabora una singola lettura glicemica parsata, ignorando per le decisioni quelle arretrate"""
+        reading = GlucoseReading.from_measurements(parsed.get("measurements", {}))
+        base_time = parsed.get("base_time")
+        if base_time is not None and now - base_time > self._max_reading_age:
+            # Lettura arretrata: le decisioni si prendono solo sulle letture recenti
+            self.last_glucose_reading = reading
+            self.log.debug("⏭️ Lettura glicemia arretrata di %.0fs ignorata per le decisioni",
+                           now - base_time)
+            return
+
+        self.process_glucose_data(reading, base_time, now)
+
+    def _enqueue_publish(self, topic, payload, qos, retain=False):
+        """Accoda un messaggio per il thread writer (non bloccante)."""
+        self._tx_queue.put((topic, payload, qos, retain))
+
+    def _tx_worker(self):
+        """
+        Thread writer: estrae i messaggi dalla coda e li pubblica.
+        Ogni NOTIFICATION_DIGEST_INTERVAL_S pubblica anche il digest delle notifiche poco gravi.
+        Termina alla ricezione della sentinella None, dopo aver svuotato il digest.
+        """
+        next_digest = time.monotonic() + self._digest_interval
+        while True:
+            try:
+                item = self._tx_queue.get(timeout=max(0.0, next_digest - time.monotonic()))
+            except queue.Empty:
+                item = ()
+
+            if item is None or time.monotonic() >= next_digest:
+                self._flush_digest()
+                next_digest = time.monotonic() + self._digest_interval
+            if item is None:
+                break
+            if item:
+                self._publish(*item)
+
+    def _publish(self, topic, payload, qos, retain=False):
+        """Pubblica un messaggio (solo dal thread writer); per QoS > 0 attende la conferma del broker."""
+        try:
+            result = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                self.log.error("❌ Errore pubblicazione su %s (rc: %s)", topic, result.rc)
+            elif qos > 0:
+                result.wait_for_publish(timeout=Config.MQTT_PUBLISH_TIMEOUT_S)
+        except Exception as e:
+            self.log.error("❌ Errore nel thread di pubblicazione (%s): %s", topic, e)
+
+    def _flush_digest(self):
+        """Pubblica in un unico pacchetto SenML le notifiche poco gravi accumulate nel digest"""
+        with self._digest_lock:
+            pending, self._digest_alerts = self._digest_alerts, []
+        if not pending:
+            return
+
+        try:
+            payload = self._encode_alerts([alert for alert, _ in pending])
+            qos = max(self._qos_by_severity.get(severity, self._qos_notif) for _, severity in pending)
+            self._publish(self.alert_topic, payload, qos)
+        except Exception as e:
+            self.log.error("❌ Errore invio digest notifiche SenML: %s", e)
+
+    def _add_iob_event(self, amount, timestamp):
+        """Registra una dose inviata negli accumulatori IOB."""
+        self._active_doses.append((timestamp, amount))
+        self._iob_units_sum += amount
+        self._iob_weighted_sum += amount * timestamp
 
     def calculate_iob(self, current_time):
-            """
-            Calcola l'Insulin-on-Board (IOB) tracciando i comandi inviati.
-            Si assume una degradazione lineare dell'insulina nell'arco di INSULIN_DURATION_SECONDS.
-            """
-            iob_units = 0.0
-            new_commands_sent = []
-
-            for command in self.insulin_commands_sent:
-                elapsed = current_time - command['timestamp']
-
-                if elapsed < self.INSULIN_DURATION_SECONDS:
-                    # IOB rimanente proporzionale al tempo rimanente
-                    time_remaining = self.INSULIN_DURATION_SECONDS - elapsed
-                    iob_ratio = time_remaining / self.INSULIN_DURATION_SECONDS
-                    iob_units += command['amount'] * iob_ratio
-                    new_commands_sent.append(command)
-            self.insulin_commands_sent[:] = new_commands_sent # Mantieni solo i comandi ancora attivi per la prossima iterazione
-            return iob_units
-
-    def process_glucose_data(self, data, timestamp):
-        print("\n" + "=" * 60)
-        print("📊 NUOVO DATO GLICEMIA RICEVUTO (SenML)")
-        print("=" * 60)
-
-        glucose_value = data.get("level", {}).get("value")
-        trend_direction = data.get("trend", {}).get("value", "stable")
-        glucose_status = data.get("status", {}).get("value", "unknown")
-        trend_rate = data.get("trend_rate", {}).get("value", 0.0)
-        battery_level = data.get("battery", {}).get("value", 100.0)
-
-        print(f"🩸 Glicemia: {glucose_value:.1f} mg/dL")
-        print(f"📈 Status: {glucose_status}")
-        print(f"📉 Trend: {trend_direction} ({trend_rate:.1f} mg/dL/min)")
-        print(f"🔋 Batteria sensore: {battery_level:.1f}%")
+        """
+        Calcola l'Insulin-on-Board (IOB) tracciando i comandi inviati.
+        Si assume una degradazione lineare dell'insulina nell'arco di INSULIN_DURATION_SECONDS.
 
+        Con dosi di ampiezza a_i inviate ai tempi t_i, l'IOB vale
+        sum(a_i * (D - (now - t_i))) / D = (A * (D - now) + sum(a_i * t_i)) / D,
+        quindi basta mantenere A e sum(a_i * t_i): le dosi scadono in ordine di invio
+        e vengono rimosse dalla testa della coda (costo O(1) ammortizzato).
+        """
+        duration = self.INSULIN_DURATION_SECONDS
+        doses = self._active_doses
+
+        while doses and current_time - doses[0][0] >= duration:
+            timestamp, amount = doses.popleft()
+            self._iob_units_sum -= amount
+            self._iob_weighted_sum -= amount * timestamp
+
+        if not doses:
+            # Azzera le somme per non accumulare errori di arrotondamento
+            self._iob_units_sum = 0.0
+            self._iob_weighted_sum = 0.0
+            return 0.0
+
+        return (self._iob_units_sum * (duration - current_time) + self._iob_weighted_sum) * self.INV_INSULIN_DURATION
+
+    def process_glucose_data(self, data, timestamp, now=None):
+        """Elabora una lettura glicemica (GlucoseReading) ricevuta in SenML"""
+        if now is None:
+            now = time.time()
+
+        glucose_value = data.level
         self.last_glucose_reading = data
 
+        # Caso più frequente: lettura nel range target, nessuna azione da valutare
+        if self._normal_low <= glucose_value <= self._normal_high:
+            return
+
+        log = self.log
+        log.debug("📊 Nuovo dato glicemia (SenML) - 🩸 %.1f mg/dL | 📈 %s | 📉 %s (%.1f mg/dL/min) | 🔋 %.1f%%",
+                  glucose_value, data.status, data.trend, data.trend_rate, data.battery)
+
+        # Attributi del paziente e limiti di sicurezza letti una sola volta
+        patient = self.patient
+        target_min = patient.target_glucose_min
+        target_max = patient.target_glucose_max
+        min_wait = self.min_time_between_corrections
+        crit_low = self._crit_low
+        crit_high = self._crit_high
+
         action_needed = False
         insulin_dose = 0.0
         alert_level = "NORMAL"
@@ -132,8 +320,8 @@ class DataCollectorConsumerSenML:
         priority = "normal"
 
         # IPOGLICEMIA
-        if self.patient.is_hypoglycemic(glucose_value):
-            if glucose_value < Config.GLUCOSE_CRITICAL_LOW:
+        if patient.is_hypoglycemic(glucose_value):
+            if glucose_value < crit_low:
                 alert_level = "EMERGENCY_LOW"
                 alert_message = f"⚠️ IPOGLICEMIA CRITICA: {glucose_value:.1f} mg/dL - Somministrare glucosio immediatamente!"
                 priority = "emergency"
@@ -141,31 +329,31 @@ class DataCollectorConsumerSenML:
                 alert_level = "WARNING_LOW"
                 alert_message = f"⚠️ IPOGLICEMIA: {glucose_value:.1f} mg/dL - Assumere 15g di carboidrati"
                 priority = "high"
-            print(f"\n🚨 {alert_message}")
-            self.send_notification(alert_level, alert_message, "critical" if glucose_value < Config.GLUCOSE_CRITICAL_LOW else "high")
+            log.warning("🚨 %s", alert_message)
+            self.send_notification(alert_level, alert_message, "critical" if glucose_value < crit_low else "high", now=now)
             action_needed = False
 
         # IPERGLICEMIA
-        elif glucose_value > self.patient.target_glucose_max:
-            target_glucose = (self.patient.target_glucose_min + self.patient.target_glucose_max) / 2
-            insulin_dose_needed = self.patient.calculate_insulin_dose(glucose_value, target_glucose)
-            iob = self.calculate_iob(time.time())
+        elif glucose_value > target_max:
+            target_glucose = self._target_glucose
+            insulin_dose_needed = patient.calculate_insulin_dose(glucose_value, target_glucose)
+            iob = self.calculate_iob(now)
 
             insulin_dose = max(0.0, insulin_dose_needed - iob)
-            is_critical_hyper = self.patient.is_hyperglycemic(glucose_value)
-            time_since_last_correction = time.time() - self.last_correction_time
+            is_critical_hyper = patient.is_hyperglycemic(glucose_value)
+            time_since_last_correction = now - self.last_correction_time
 
-            print(f"   [DBG] Dose necessaria (senza IOB): {insulin_dose_needed:.2f}U")
-            print(f"   [DBG] Insulina Attiva (IOB): {iob:.2f}U")
-            print(f"   [DBG] Dose finale da somministrare: {insulin_dose:.2f}U")
+            log.debug("Dose necessaria (senza IOB): %.2fU | IOB: %.2fU | Dose finale: %.2fU",
+                      insulin_dose_needed, iob, insulin_dose)
 
-            if insulin_dose > 0 and time_since_last_correction > self.min_time_between_corrections:
+            if insulin_dose > 0 and time_since_last_correction > min_wait:
 
-                insulin_dose = min(insulin_dose, self.max_bolus_dose) # Applica il limite massimo di bolo
+                # Applica il limite massimo di bolo e arrotonda una sola volta alla risoluzione della pompa (0.01U)
+                insulin_dose = round(min(insulin_dose, self.max_bolus_dose), 2)
                 action_needed = True
 
                 # Aggiorna il messaggio in base al livello di severità
-                if glucose_value > Config.GLUCOSE_CRITICAL_HIGH or is_critical_hyper:
+                if glucose_value > crit_high or is_critical_hyper:
                     alert_level = "EMERGENCY_HIGH"
                     alert_message = f"🚨 IPERGLICEMIA CRITICA: {glucose_value:.1f} mg/dL - Somministrazione {insulin_dose:.2f}U insulina"
                     priority = "emergency"
@@ -173,31 +361,28 @@ class DataCollectorConsumerSenML:
                     alert_level = "WARNING_HIGH"
                     alert_message = f"⚠️ GLICEMIA ALTA: {glucose_value:.1f} mg/dL - Correzione con {insulin_dose:.2f}U insulina"
                     priority = "high"
-                print(f"\n💉 Dose insulina calcolata (netta): {insulin_dose:.2f} unità")
-                print(f"🎯 Target glicemico: {target_glucose:.1f} mg/dL")
-                print(f"⚡ Priorità comando: {priority}")
+                log.info("💉 Dose insulina calcolata (netta): %.2f unità | 🎯 Target: %.1f mg/dL | ⚡ Priorità: %s",
+                         insulin_dose, target_glucose, priority)
 
-                self.send_notification(alert_level, alert_message, "critical" if glucose_value > Config.GLUCOSE_CRITICAL_HIGH else "high")
+                self.send_notification(alert_level, alert_message, "critical" if glucose_value > crit_high else "high", now=now)
 
             elif insulin_dose_needed > 0 and insulin_dose <= 0:
 
-                iob = self.calculate_iob(time.time())
+                iob = self.calculate_iob(now)
                 msg = f"Iperglicemia rilevata ({glucose_value} mg/dL) ma IOB sufficiente ({iob:.2f}U). Nessun bolo extra."
-                print(f"✅ {msg}")
-                self.send_notification("INFO", msg, "low")
+                log.info("✅ %s", msg)
+                self.send_notification("INFO", msg, "low", now=now)
 
             elif insulin_dose > 0:
-                remaining = self.min_time_between_corrections - time_since_last_correction
-                print(f"⏳ Attesa tra correzioni: {remaining:.0f}s rimanenti")
+                remaining = min_wait - time_since_last_correction
+                log.debug("⏳ Attesa tra correzioni: %.0fs rimanenti", remaining)
                 if not self.waiting_notification_sent:
-                    self.send_notification("INFO", "⏳ Iperglicemia rilevata: in attesa della correzione precedente",
-                                           "low")
-                    self.waiting_notification_sent = True
+                    self.waiting_notification_sent = self.send_notification(
+                        "INFO", "⏳ Iperglicemia rilevata: in attesa della correzione precedente", "low", now=now)
 
         # VALORI NORMALI
         else:
-            print(
-                f" Glicemia nel range target ({self.patient.target_glucose_min}-{self.patient.target_glucose_max} mg/dL)")
+            log.debug("Glicemia nel range target (%s-%s mg/dL)", target_min, target_max)
 
         if action_needed and insulin_dose > 0:
             reason = f"Glucose level: {glucose_value:.1f} mg/dL (High)"
@@ -205,56 +390,58 @@ class DataCollectorConsumerSenML:
                 insulin_amount=insulin_dose,
                 delivery_mode="correction",
                 priority=priority,
-                reason=reason
+                reason=reason,
+                now=now
             )
-            self.last_correction_time = time.time()
+            self.last_correction_time = now
             self.waiting_notification_sent = False
 
-        print("=" * 60 + "\n")
-
-    def process_pump_status(self, data, timestamp):
+    def process_pump_status(self, data, timestamp, now=None):
         """Elabora lo status pompa da messaggio SenML"""
+        if now is None:
+            now = time.time()
+
         self.last_pump_status = data
-        pump_status = data.get("status", {}).get("value", "active")
-        insulin_level = data.get("reservoir", {}).get("value", 0)
-        reservoir_pct = data.get("reservoir_pct", {}).get("value", 0)
-        battery_level = data.get("battery", {}).get("value", 0)
-        basal_rate = data.get("basal_rate", {}).get("value", 0)
-        total_daily = data.get("total_daily_insulin", {}).get("value", 0)
-        alarms_count = data.get("alarms_count", {}).get("value", 0)
-        alarms_str = data.get("alarms", {}).get("value", "")
-        last_bolus = data.get("last_bolus", {}).get("value")
-
-        print(f"\n📊 Status pompa SenML ricevuto: {pump_status}")
-        print(f"   💉 Insulina: {insulin_level:.1f}U ({reservoir_pct:.0f}%)")
-        print(f"   🔋 Batteria: {battery_level:.1f}%")
-        print(f"   ⚙️  Rate basale: {basal_rate:.2f} U/h")
-        print(f"   📈 Totale giornaliero: {total_daily:.1f}U")
+        pump_status = data.get("status", "active")
+        insulin_level = data.get("reservoir", 0)
+        reservoir_pct = data.get("reservoir_pct", 0)
+        battery_level = data.get("battery", 0)
+        basal_rate = data.get("basal_rate", 0)
+        total_daily = data.get("total_daily_insulin", 0)
+        alarms_count = data.get("alarms_count", 0)
+        alarms_str = data.get("alarms", "")
+        # Allarmi separati da virgola: insieme per controlli di appartenenza esatti e O(1)
+        alarms = frozenset(alarms_str.split(",")) if alarms_str else NO_ALARMS
+        last_bolus = data.get("last_bolus")
+
+        log = self.log
+        log.debug("📊 Status pompa SenML: %s | 💉 %.1fU (%.0f%%) | 🔋 %.1f%% | ⚙️ %.2f U/h | 📈 %.1fU/giorno",
+                  pump_status, insulin_level, reservoir_pct, battery_level, basal_rate, total_daily)
 
         if last_bolus is not None:
-            print(f"   💊 Ultimo bolo: {last_bolus:.1f}U")
+            log.debug("💊 Ultimo bolo: %.1fU", last_bolus)
         if alarms_count > 0:
-            print(f"   🚨 Allarmi attivi ({alarms_count}): {alarms_str}")
+            log.warning("🚨 Allarmi pompa attivi (%s): %s", alarms_count, alarms_str)
 
         # Gestione allarmi
-        if insulin_level < 30 and "low_insulin" not in alarms_str:
+        if insulin_level < 30 and "low_insulin" not in alarms:
             self.send_notification("WARNING",
                                    f"⚠️ Insulina quasi terminata ({insulin_level:.1f}U)",
-                                   "high")
-        if battery_level < 20 and "low_battery" not in alarms_str:
+                                   "high", now=now)
+        if battery_level < 20 and "low_battery" not in alarms:
             self.send_notification("WARNING",
                                    f"🔋 Batteria pompa bassa ({battery_level:.0f}%)",
-                                   "medium")
+                                   "medium", now=now)
         if insulin_level <= 0:
             self.send_notification("EMERGENCY",
                                    "🚨 POMPA INSULINA VUOTA - Ricaricare immediatamente!",
-                                   "critical")
-        if "battery_critical" in alarms_str:
+                                   "critical", now=now)
+        if "battery_critical" in alarms:
             self.send_notification("EMERGENCY",
                                    "🚨 BATTERIA CRITICA - Sostituire immediatamente!",
-                                   "critical")
+                                   "critical", now=now)
 
-    def create_insulin_command_senml(self, insulin_amount, delivery_mode, priority, reason):
+    def create_insulin_command_senml(self, insulin_amount, delivery_mode, priority, reason, timestamp=None):
         """
         Formato generato:
         [
@@ -265,47 +452,38 @@ class DataCollectorConsumerSenML:
             {"n": "priority", "vs": "high"},
             {"n": "reason", "vs": "High glucose detected"}
         ]
+
+        Con orjson o CBOR si aggiornano in place i record allocati in __init__; altrimenti il
+        payload viene prodotto formattando il template pre-codificato: delivery_mode e priority
+        appartengono a insiemi chiusi, mentre reason (testo libero) viene serializzato come
+        stringa JSON con SenMLHelper.json_bytes.
         """
-        base_name = f"urn:patient:{self.patient_id}:insulin:command:"
-        timestamp = time.time()
+        if timestamp is None:
+            timestamp = time.time()
         command_id = f"cmd_{uuid.uuid4().hex[:8]}"
 
-        senml_record = [
-            {
-                "bn": base_name,
-                "bt": timestamp
-            },
-            {
-                "n": "dose",
-                "v": round(insulin_amount, 2),
-                "u": "U",
-                "t": 0
-            },
-            {
-                "n": "type",
-                "vs": delivery_mode,
-                "t": 0
-            },
-            {
-                "n": "command_id",
-                "vs": command_id,
-                "t": 0
-            },
-            {
-                "n": "priority",
-                "vs": priority,
-                "t": 0
-            },
-            {
-                "n": "reason",
-                "vs": reason,
-                "t": 0
-            }
-        ]
-
-        return json.dumps(senml_record), command_id
-
-    def send_insulin_command_senml(self, insulin_amount, delivery_mode, priority, reason):
+        if self._command_template is None:
+            records = self._command_records
+            records[0]["bt"] = timestamp
+            records[1]["v"] = insulin_amount
+            records[2]["vs"] = delivery_mode
+            records[3]["vs"] = command_id
+            records[4]["vs"] = priority
+            records[5]["vs"] = reason
+            return SenMLHelper.encode_senml(records), command_id
+
+        payload = self._command_template % (
+            timestamp,
+            insulin_amount,
+            SenMLHelper.enum_json(delivery_mode),
+            command_id.encode(),
+            SenMLHelper.enum_json(priority),
+            SenMLHelper.json_bytes(reason)
+        )
+
+        return payload, command_id
+
+    def send_insulin_command_senml(self, insulin_amount, delivery_mode, priority, reason, now=None):
         """
         Invia comando alla pompa in formato SenML compatibile
 
@@ -314,35 +492,37 @@ class DataCollectorConsumerSenML:
             delivery_mode: Modalità erogazione ("bolus", "correction", "basal")
             priority: Priorità comando ("normal", "high", "emergency")
             reason: Motivo del comando
+            now: Timestamp corrente già letto dal chiamante (opzionale)
         """
+        if now is None:
+            now = time.time()
+
         try:
             command_senml, command_id = self.create_insulin_command_senml(
                 insulin_amount=insulin_amount,
                 delivery_mode=delivery_mode,
                 priority=priority,
-                reason=reason
+                reason=reason,
+                timestamp=now
             )
 
-            result = self.client.publish(
-                self.pump_command_topic,
-                command_senml,
-                qos=Config.QOS_COMMANDS,
-                retain=False
-            )
-
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"\n💉 Comando insulina SenML inviato:")
-                print(f"   🆔 Command ID: {command_id}")
-                print(f"   💊 Dose: {insulin_amount:.2f}U")
-                print(f"   📋 Tipo: {delivery_mode}")
-                print(f"   ⚡ Priorità: {priority}")
-                print(f"   📝 Motivo: {reason}")
-                print(f"   📤 Topic: {self.pump_command_topic}")
+            if priority == "emergency":
+                # Percorso prioritario: publish immediato senza attendere i messaggi in coda al writer.
+                # Nessun wait_for_publish: dal thread di rete bloccherebbe il loop che riceve la conferma
+                result = self.client.publish(self.pump_command_topic, command_senml, qos=self._qos_cmd)
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.log.error("❌ Errore pubblicazione comando di emergenza (rc: %s)", result.rc)
             else:
-                print(f"❌ Errore pubblicazione comando (rc: {result.rc})")
+                self._enqueue_publish(self.pump_command_topic, command_senml, self._qos_cmd)
+
+            self.log.info("💉 Comando insulina SenML inviato: 🆔 %s | 💊 %.2fU | 📋 %s | ⚡ %s | 📝 %s | 📤 %s",
+                          command_id, insulin_amount, delivery_mode, priority, reason, self.pump_command_topic)
 
+            self._add_iob_event(insulin_amount, now)
+            self._total_commands += 1
+            self._total_insulin += insulin_amount
             self.insulin_commands_sent.append({
-                'timestamp': time.time(),
+                'timestamp': now,
                 'command_id': command_id,
                 'amount': insulin_amount,
                 'delivery_mode': delivery_mode,
@@ -351,9 +531,9 @@ class DataCollectorConsumerSenML:
             })
 
         except Exception as e:
-            print(f"❌ Errore invio comando insulina SenML: {e}")
+            self.log.error("❌ Errore invio comando insulina SenML: %s", e)
 
-    def send_notification(self, alert_level, message, severity="medium"):
+    def send_notification(self, alert_level, message, severity="medium", now=None):
         """
         Invia notifica al topic alerts in SenML
 
@@ -361,39 +541,95 @@ class DataCollectorConsumerSenML:
             alert_level: Livello alert (es. "WARNING_HIGH", "EMERGENCY_LOW")
             message: Messaggio descrittivo
             severity: Gravità ("low", "medium", "high", "critical")
+            now: Timestamp corrente già letto dal chiamante (opzionale)
+
+        Le notifiche non critiche con stesso (alert_level, severity) dell'ultima
+        inviata vengono soppresse per NOTIFICATION_DEDUP_WINDOW_S secondi, tranne
+        le INFO (messaggi diversi con lo stesso livello); quelle con gravità in
+        NOTIFICATION_DIGEST_SEVERITIES escono nel digest periodico.
+
+        Returns:
+            True se la notifica è stata accodata, False se soppressa o in errore
         """
-        try:
-            alert_senml = SenMLHelper.create_notification_alert(
-                patient_id=self.patient_id,
-                alert_type=alert_level,
-                message=message,
-                severity=severity,
-                timestamp=time.time()
-            )
+        if now is None:
+            now = time.time()
+        alert_key = (alert_level, severity)
+        if (severity != "critical" and alert_level != "INFO" and alert_key == self._last_alert
+                and now - self._last_alert_t < self._dedup_window):
+            return False
 
-            self.client.publish(
-                self.alert_topic,
-                alert_senml,
-                qos=Config.QOS_NOTIFICATIONS,
-                retain=False
-            )
+        try:
+            if self._alert_template is None:
+                alert = SenMLHelper.notification_alert_records(
+                    patient_id=self.patient_id,
+                    alert_type=alert_level,
+                    message=message,
+                    severity=severity,
+                    timestamp=now
+                )
+            else:
+                alert = self._alert_template % (
+                    now,
+                    SenMLHelper.json_bytes(alert_level),
+                    SenMLHelper.json_bytes(message),
+                    SenMLHelper.enum_json(severity)
+                )
+
+            if severity in self._digest_severities:
+                with self._digest_lock:
+                    self._digest_alerts.append((alert, severity))
+            elif self._pending_alerts is not None:
+                self._pending_alerts.append((alert, severity))
+            else:
+                self._enqueue_publish(
+                    self.alert_topic,
+                    self._encode_alerts([alert]),
+                    self._qos_by_severity.get(severity, self._qos_notif)
+                )
+            self._last_alert = alert_key
+            self._last_alert_t = now
 
-            severity_emoji = {"low": "ℹ️", "medium": "⚠️", "high": "🔶", "critical": "🚨"}
-            emoji = severity_emoji.get(severity, "📢")
-            print(f"{emoji} Notifica SenML inviata: [{alert_level}] {severity}")
+            self.log.info("%s Notifica SenML inviata: [%s] %s",
+                          SEVERITY_EMOJI.get(severity, "📢"), alert_level, severity)
 
             self.alert_history.append({
-                'timestamp': time.time(),
+                'timestamp': now,
                 'level': alert_level,
                 'message': message,
                 'severity': severity
             })
+            return True
+
+        except Exception as e:
+            self.log.error("❌ Errore invio notifica SenML: %s", e)
+            return False
 
-            if len(self.alert_history) > 10:
-                self.alert_history = self.alert_history[-10:]
+    def flush_notifications(self):
+        """
+        Pubblica in un unico pacchetto SenML le notifiche accumulate durante
+        l'elaborazione di una lettura, con la QoS della notifica più grave
+        """
+        pending, self._pending_alerts = self._pending_alerts, None
+        if not pending:
+            return
 
+        try:
+            payload = self._encode_alerts([alert for alert, _ in pending])
+            qos_by_severity = self._qos_by_severity
+            qos_notif = self._qos_notif
+            qos = max(qos_by_severity.get(severity, qos_notif) for _, severity in pending)
+            self._enqueue_publish(self.alert_topic, payload, qos)
         except Exception as e:
-            print(f"❌ Errore invio notifica SenML: {e}")
+            self.log.error("❌ Errore invio notifiche SenML: %s", e)
+
+    def _encode_alerts(self, alerts):
+        """
+        Serializza uno o più alert in un unico pacchetto SenML: senza orjson gli alert sono
+        frammenti bytes prodotti da _alert_template, altrimenti liste di record (JSON o CBOR)
+        """
+        if self._alert_template is None:
+            return SenMLHelper.encode_senml([record for records in alerts for record in records])
+        return b"[" + b",".join(alerts) + b"]"
 
     def start(self):
         """Avvia il Data Collector"""
@@ -410,7 +646,11 @@ class DataCollectorConsumerSenML:
             print("=" * 60 + "\n")
 
             self.client.connect(self.broker_address, self.broker_port, Config.MQTT_KEEPALIVE_S)
-            self.client.loop_forever()
+
+            # Loop di rete in un thread dedicato, pubblicazioni nel thread writer
+            self.client.loop_start()
+            self._tx_thread.start()
+            self._stop_event.wait()
 
         except KeyboardInterrupt:
             print("\n⏹️  Data Collector fermato dall'utente")
@@ -422,16 +662,19 @@ class DataCollectorConsumerSenML:
     def stop(self):
         """Ferma il Data Collector"""
         print("\n🛑 Chiusura Data Collector...")
+        self._stop_event.set()
+        if self._tx_thread.is_alive():
+            # Sentinella: il writer svuota i messaggi già accodati e termina
+            self._tx_queue.put(None)
+            self._tx_thread.join(timeout=Config.MQTT_PUBLISH_TIMEOUT_S)
         self.client.disconnect()
+        self.client.loop_stop()
         print("✅ Data Collector disconnesso")
 
     def get_statistics(self):
-        total_commands = len(self.insulin_commands_sent)
-        total_insulin = sum(cmd['amount'] for cmd in self.insulin_commands_sent)
-
         return {
-            'total_commands_sent': total_commands,
-            'total_insulin_commanded': total_insulin,
+            'total_commands_sent': self._total_commands,
+            'total_insulin_commanded': self._total_insulin,
             'total_alerts': len(self.alert_history),
             'last_glucose': self.last_glucose_reading,
             'last_pump_status': self.last_pump_status
@@ -445,22 +688,15 @@ class DataCollectorConsumerSenML:
             info_topic = f"{self.base_topic}/{Config.PATIENT_INFO_TOPIC}"
             patient_senml = self.patient.to_senml()
 
-            result = self.client.publish(
-                info_topic,
-                patient_senml,
-                qos=Config.QOS_NOTIFICATIONS,
-                retain=True
-            )
-
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"ℹ️ Info paziente pubblicate con successo su: {info_topic}")
-            else:
-                print(f"⚠️ Errore pubblicazione info paziente: {result.rc}")
+            self._enqueue_publish(info_topic, patient_senml, Config.QOS_NOTIFICATIONS, retain=True)
+            print(f"ℹ️ Info paziente accodate per la pubblicazione su: {info_topic}")
 
         except Exception as e:
             print(f"❌ Errore durante la pubblicazione delle info paziente: {e}")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=Config.COLLECTOR_LOG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
+
     CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'conf','patient_config.json')
 
     try:
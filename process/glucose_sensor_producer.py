@@ -1,48 +1,121 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import time
 import sys
 import os
+import queue
+import threading
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import random
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from model.glucose_sensor_data import GlucoseSensorData
 from model.glucose_simulation_logic import GlucoseSimulationLogic
 from model.patient_descriptor import PatientDescriptor
 from conf.SystemConfiguration import SystemConfig as Config
-from utils.senml_helper import SenMLHelper
+from utils.senml_helper import SenMLHelper, ORJSON_AVAILABLE
+from utils.mqtt_socket import enable_tcp_nodelay
+from utils.ring_log_handler import RingBufferHandler
 
 class GlucoseSensorProducerSenML:
     def __init__(self, sensor_id, patient_id, initial_glucose=None, simulation_mode="normal"):
         self.sensor_id = sensor_id
         self.patient_id = patient_id
+        self.log = logging.getLogger("glucose_sensor")
         start_val = initial_glucose if initial_glucose is not None else Config.SIM_SENSOR_START_VALUE
         self.sensor = GlucoseSensorData(sensor_id, patient_id, glucose_value=start_val)
 
         # Configurazione MQTT
         self.broker_address = Config.BROKER_ADDRESS
         self.broker_port = Config.BROKER_PORT
-        self.client = mqtt.Client(f"glucose_sensor_senml_{sensor_id}")
+        # MQTT v5: le letture portano un Message Expiry Interval, le copie non consegnate scadono sul broker
+        self.client = mqtt.Client(f"glucose_sensor_senml_{sensor_id}", protocol=mqtt.MQTTv5)
+        self._publish_props = Properties(PacketTypes.PUBLISH)
+        self._publish_props.MessageExpiryInterval = Config.SENSOR_MESSAGE_EXPIRY_S
 
         # Topic MQTT
         self.base_topic = f"/iot/patient/{patient_id}"
         self.publish_topic = f"{self.base_topic}/glucose/sensor/data"
+        self.state_topic = f"{self.base_topic}/glucose/sensor/state"
+        self.critical_topic = f"{self.base_topic}/glucose/sensor/critical"
         self.command_topic = f"{self.base_topic}/insulin/pump/command"
         self.control_topic = f"{self.base_topic}/glucose/sensor/set_mode"
 
         # Letture
         self.reading_interval = Config.GLUCOSE_READING_INTERVAL
         self.simulation_mode = simulation_mode
+        # Funzione di variazione della modalità corrente (riassegnata solo al cambio modalità)
+        self._variation = GlucoseSimulationLogic.variation_for_mode(simulation_mode)
         self.reading_count = 0
 
+        # Batch di letture pubblicate in un unico pacchetto SenML
+        self.batch_size = Config.SENSOR_BATCH_SIZE
+        self.batch_records = []
+        self._batch_readings = 0
+        self._batch_first_count = 0
+
+        # Record SenML della lettura allocati una volta (bn, unità e nomi sono costanti):
+        # per la pubblicazione singola si aggiornano in place solo tempo e valori
+        self._senml_template = self.sensor.to_senml_records()
+        # Senza orjson: stesso pacchetto già serializzato in JSON, per ogni lettura si formattano
+        # solo i valori invece di passare da json.dumps
+        self._senml_json_template = None
+        if not ORJSON_AVAILABLE and not Config.SENML_CBOR_ENABLED:
+            base_name = SenMLHelper.json_bytes(self._senml_template[0]["bn"]).replace(b"%", b"%%")
+            self._senml_json_template = (
+                b'[{"bn":' + base_name + b',"bt":%r},'
+                b'{"n":"level","v":%r,"t":0},'
+                b'{"n":"status","vs":"%s"},'
+                b'{"n":"trend","vs":"%s"},'
+                b'{"n":"trend_rate","v":%r,"u":"mg/dL/min","t":0},'
+                b'{"n":"battery","v":%r,"u":"%%","t":0},'
+                b'{"n":"signal","v":%d,"u":"dBm","t":0},'
+                b'{"n":"sensor_status","vs":"%s","t":0},'
+                b'{"n":"confidence","v":%r,"u":"ratio","t":0},'
+                b'{"n":"calibration_needed","vb":%s}]'
+            )
+
+        # Publish-on-change (l'ultimo stato resta disponibile ai nuovi subscriber sul topic state retained)
+        self.dedupe = Config.SENSOR_DEDUPE_ENABLED
+        self.dedupe_epsilon = Config.SENSOR_DEDUPE_EPSILON
+        self.heartbeat_readings = Config.SENSOR_HEARTBEAT_READINGS
+        self._last_published = None  # (valore, stato, trend) dell'ultima lettura pubblicata
+        self._dedupe_skipped = 0
+
+        # Stato retained (ultima lettura) a bassa frequenza, separato dal flusso volatile QoS 0
+        self.state_every = Config.SENSOR_STATE_EVERY_READINGS
+        self._readings_since_state = 0
+        self._qos_data = Config.QOS_SENSOR_DATA  # QoS dei topic retained state/critical
+        # True finché sul topic critical resta un messaggio retained da cancellare
+        self._critical_retained = False
+
         # Parametri per l'effetto insulina
         self.active_insulin_doses = []
         self.insulin_sensitivity_factor = Config.INSULIN_CORRECTION_FACTOR
+        # Comandi insulina grezzi (istante di arrivo, payload) accodati dal thread di rete di paho:
+        # il parsing avviene nel ciclo letture, unico thread che tocca active_insulin_doses
+        self._command_inbox = queue.SimpleQueue()
+
+        # Generatore casuale privato della simulazione (evita il generatore globale del modulo random)
+        self._rng = random.Random()
+
+        # Coda limitata di pubblicazione svuotata da un thread writer: il ciclo di simulazione
+        # non si blocca mai su publish durante riconnessioni o rallentamenti del broker
+        self._tx_queue = queue.Queue(maxsize=Config.SENSOR_TX_QUEUE_SIZE)
+        self._tx_thread = threading.Thread(target=self._tx_worker, name="glucose_sensor_tx", daemon=True)
 
         # Callbacks
+        self.client.on_socket_open = enable_tcp_nodelay
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             print(f"✅ Sensore glicemia connesso")
             print(f"Topic pubblicazione: {self.publish_topic}")
@@ -52,68 +125,210 @@ class GlucoseSensorProducerSenML:
         else:
             print(f"❌ Connessione fallita: rc={rc}")
 
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         if rc != 0:
             print(f"⚠️ Disconnessione inattesa (rc={rc})")
 
     def on_message(self, client, userdata, msg):
         try:
-            payload = msg.payload.decode()
-
             if msg.topic == self.control_topic:
-                self.change_simulation_mode(payload)
+                self.change_simulation_mode(msg.payload.decode())
 
-            if "insulin/pump/command" in msg.topic:
-                parsed = SenMLHelper.parse_senml(payload)
-                data = parsed.get("measurements", {})
-                dose = data.get("dose", {}).get("value", 0.0)
-                d_type = data.get("type", {}).get("value", "bolus")
+            elif msg.topic == self.command_topic:
+                self._command_inbox.put((time.time(), msg.payload))
+
+        except Exception as e:
+            self.log.error("❌ Errore comando sensore: %s", e)
+
+    def _process_commands(self):
+        """Decodifica i comandi insulina ricevuti dall'ultima lettura e registra le dosi attive"""
+        inbox = self._command_inbox
+        while not inbox.empty():
+            received_at, payload = inbox.get_nowait()
+            try:
+                data = SenMLHelper.parse_senml(payload).get("measurements", {})
+                dose = data.get("dose", 0.0)
+                d_type = data.get("type", "bolus")
 
                 if dose > 0 and d_type in ["bolus", "correction"]:
-                    self.active_insulin_doses.append({'amount': dose, 'start_time': time.time()})
-                    print(f"💉 Sensore: Rilevata insulina {dose:.2f}U")
+                    self.active_insulin_doses.append({'amount': dose, 'start_time': received_at})
+                    self.log.info("💉 Sensore: Rilevata insulina %.2fU", dose)
 
-        except Exception as e:
-            print(f"❌ Errore comando sensore: {e}")
+            except Exception as e:
+                self.log.error("❌ Errore comando sensore: %s", e)
+
+    def _enqueue_publish(self, payload, topic=None, qos=Config.QOS_SENSOR_TELEMETRY, retain=False):
+        """Accoda un messaggio (di default sul flusso letture) per il thread writer; se la coda è piena scarta il più vecchio."""
+        item = (topic or self.publish_topic, payload, qos, retain)
+        while True:
+            try:
+                self._tx_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._tx_queue.get_nowait()
+                    self.log.warning("⚠️ Coda di pubblicazione piena: scartata la lettura più vecchia")
+                except queue.Empty:
+                    pass
+
+    def _tx_worker(self):
+        """Thread writer: pubblica i messaggi in coda fino alla sentinella None."""
+        get = self._tx_queue.get
+        publish = self.client.publish
+        properties = self._publish_props
+        timeout = Config.MQTT_PUBLISH_TIMEOUT_S
+        while True:
+            item = get()
+            if item is None:
+                break
+
+            topic, payload, qos, retain = item
+            try:
+                result = publish(topic, payload, qos=qos, retain=retain, properties=properties)
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.log.error("❌ Errore pubblicazione (rc: %s)", result.rc)
+                elif qos > 0:
+                    result.wait_for_publish(timeout=timeout)
+            except Exception as e:
+                self.log.error("❌ Errore pubblicazione: %s", e)
 
     def simulate_glucose_reading(self):
+        now = time.time()
+        self._process_commands()
         # Variazione naturale
-        natural_variation = GlucoseSimulationLogic.generate_variation(
-            current_value=self.sensor.glucose_value,
-            simulation_mode=self.simulation_mode
-        )
+        natural_variation = self._variation(self._rng.random)
         # Effetto insulina
         insulin_effect = GlucoseSimulationLogic.calculate_insulin_effect(
             active_insulin_doses=self.active_insulin_doses,
             isf=self.insulin_sensitivity_factor,
-            current_time=time.time(),
+            current_time=now,
             reading_interval=self.reading_interval
         )
         total_variation = natural_variation + insulin_effect
         if insulin_effect < -0.1: # Log per debug
-            print(f"   [DBG] Var. Naturale: {natural_variation:.1f}, Effetto Insulina: {insulin_effect:.1f}")
-        self.sensor.apply_variation(total_variation, self.reading_interval)
+            self.log.debug("Var. Naturale: %.1f, Effetto Insulina: %.1f", natural_variation, insulin_effect)
+        self.sensor.apply_variation(total_variation, self.reading_interval, self._rng, now)
         return self.sensor
 
     def publish_reading(self):
         try:
             self.reading_count += 1
             reading = self.simulate_glucose_reading()
-            senml_json = reading.to_senml()
-            self.client.publish(self.publish_topic, senml_json, qos=Config.QOS_SENSOR_DATA)
+
+            critical = reading.is_critical()
+            if self.dedupe and not critical:
+                last = self._last_published
+                if (last is not None
+                        and abs(reading.glucose_value - last[0]) < self.dedupe_epsilon
+                        and reading.glucose_status == last[1] and reading.trend_direction == last[2]
+                        and self._dedupe_skipped + 1 < self.heartbeat_readings):
+                    self._dedupe_skipped += 1
+                    self.log.debug("Lettura #%d | %.1f mg/dL | invariata, non pubblicata",
+                                   self.reading_count, reading.glucose_value)
+                    return
+            self._last_published = (reading.glucose_value, reading.glucose_status, reading.trend_direction)
+            self._dedupe_skipped = 0
+
+            single_payload = None
+            if self.batch_size <= 1:
+                single_payload = self._encode_reading(reading)
+                self._enqueue_publish(single_payload)
+            else:
+                self._add_to_batch(reading)
+                if critical or self._batch_readings >= self.batch_size:
+                    # Con un valore critico il batch parte subito senza attendere le letture mancanti
+                    self.flush_batch()
+
+            # Letture critiche anche sul topic critical (QoS 1, retained); al rientro il retained viene cancellato
+            if critical:
+                if single_payload is None:
+                    single_payload = self._encode_reading(reading)
+                self._enqueue_publish(single_payload, topic=self.critical_topic, qos=self._qos_data, retain=True)
+                self._critical_retained = True
+            elif self._critical_retained:
+                self._enqueue_publish(b"", topic=self.critical_topic, qos=self._qos_data, retain=True)
+                self._critical_retained = False
+
+            self._readings_since_state += 1
+            if self._readings_since_state >= self.state_every or self.reading_count == 1:
+                if single_payload is None:
+                    single_payload = self._encode_reading(reading)
+                self._enqueue_publish(single_payload, topic=self.state_topic, qos=self._qos_data, retain=True)
+                self._readings_since_state = 0
 
             # Log compatto
-            print(f"Lettura #{self.reading_count} | {reading.glucose_value:.1f} mg/dL | {reading.trend_direction}({reading.trend_rate:.1f} mg/dL/min) | {reading.battery_level:.1f}% |📡:{reading.signal_strength} dBm")
-            if reading.is_critical():
-                print("🚨 Valore critico!")
+            log = self.log
+            if log.isEnabledFor(logging.INFO):
+                log.info("Lettura #%d | %.1f mg/dL | %s(%.1f mg/dL/min) | %.1f%% | %s dBm",
+                         self.reading_count, reading.glucose_value, reading.trend_direction,
+                         reading.trend_rate, reading.battery_level, reading.signal_strength)
+            if critical:
+                log.warning("🚨 Valore critico: %.1f mg/dL", reading.glucose_value)
 
         except Exception as e:
-            print(f"❌ Errore pubblicazione: {e}")
+            self.log.error("❌ Errore pubblicazione: %s", e)
+
+    def _encode_reading(self, reading):
+        """Payload SenML di una singola lettura: record aggiornati in place (orjson/CBOR) o template JSON pre-serializzato"""
+        if self._senml_json_template is None:
+            return SenMLHelper.encode_senml(self._update_senml_template(reading))
+        return self._senml_json_template % (
+            float(reading.timestamp),
+            reading.glucose_value,
+            reading.glucose_status.encode(),
+            reading.trend_direction.encode(),
+            reading.trend_rate,
+            reading.battery_level,
+            reading.signal_strength,
+            reading.sensor_status.encode(),
+            reading.confidence_level,
+            b"true" if reading.calibration_needed else b"false"
+        )
+
+    def _update_senml_template(self, reading):
+        """Aggiorna i campi variabili del template SenML (ordine di SenMLHelper.glucose_sensor_records)"""
+        records = self._senml_template
+        records[0]["bt"] = float(reading.timestamp)
+        records[1]["v"] = reading.glucose_value
+        records[2]["vs"] = reading.glucose_status
+        records[3]["vs"] = reading.trend_direction
+        records[4]["v"] = reading.trend_rate
+        records[5]["v"] = reading.battery_level
+        records[6]["v"] = reading.signal_strength
+        records[7]["vs"] = reading.sensor_status
+        records[8]["v"] = reading.confidence_level
+        records[9]["vb"] = reading.calibration_needed
+        return records
+
+    def _add_to_batch(self, reading):
+        """
+        Aggiunge una lettura al batch: la prima porta bn e bt, le successive solo
+        l'offset relativo "t" (letture trascorse * intervallo) su ciascun record
+        """
+        records = reading.to_senml_records()
+        if not self.batch_records:
+            self._batch_first_count = self.reading_count
+            self.batch_records.extend(records)
+        else:
+            offset = (self.reading_count - self._batch_first_count) * self.reading_interval
+            for record in records[1:]:  # Salta il record base (bn/bt)
+                record["t"] = offset
+            self.batch_records.extend(records[1:])
+        self._batch_readings += 1
+
+    def flush_batch(self):
+        """Pubblica le letture accumulate nel batch come unico pacchetto SenML"""
+        if not self.batch_records:
+            return
+        records, self.batch_records = self.batch_records, []
+        self._batch_readings = 0
+        self._enqueue_publish(SenMLHelper.encode_senml(records))
 
     def change_simulation_mode(self, new_mode):
         valid = ["normal", "hypoglycemia", "hyperglycemia", "fluctuating"]
         if new_mode in valid:
             self.simulation_mode = new_mode
+            self._variation = GlucoseSimulationLogic.variation_for_mode(new_mode)
             print(f"🎭 Modalità: {new_mode}")
 
     def run_continuous(self):
@@ -121,20 +336,60 @@ class GlucoseSensorProducerSenML:
             print("🚀 AVVIO SENSORE GLICEMIA")
             self.client.connect(self.broker_address, self.broker_port, Config.MQTT_KEEPALIVE_S)
             self.client.loop_start()
+            self._tx_thread.start()
 
+            # Scadenze assolute: il periodo resta reading_interval indipendentemente dal tempo di pubblicazione
+            max_lag = Config.SENSOR_MAX_LAG_INTERVALS * self.reading_interval
+            next_tick = time.monotonic()
             while True:
                 self.publish_reading()
-                time.sleep(self.reading_interval)
+                next_tick += self.reading_interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > max_lag:
+                    # Troppo in ritardo (es. sistema sospeso): riparte dalla scadenza corrente invece di recuperare a raffica
+                    self.log.warning("⚠️ Ciclo letture in ritardo di %.1fs: riallineamento", -delay)
+                    next_tick = time.monotonic()
 
         except KeyboardInterrupt:
             self.stop()
 
     def stop(self):
+        try:
+            self.flush_batch()
+        except Exception as e:
+            print(f"❌ Errore pubblicazione batch finale: {e}")
+        if self._tx_thread.is_alive():
+            # Sentinella: il writer pubblica i messaggi già accodati e termina
+            self._tx_queue.put(None)
+            self._tx_thread.join(timeout=Config.MQTT_PUBLISH_TIMEOUT_S)
         self.client.loop_stop()
         self.client.disconnect()
 
 
 if __name__ == "__main__":
+    log_level = "WARNING" if "--quiet" in sys.argv else Config.SENSOR_LOG_LEVEL
+    log_format = "%(asctime)s %(levelname)s %(message)s"
+    ring_handler = None
+    log_listener = None
+    if "--ring-log" in sys.argv:
+        # Modalità bench/stress: su stderr solo WARNING ed errori, il resto in un buffer circolare
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.WARNING)
+        ring_handler = RingBufferHandler(Config.SENSOR_RING_LOG_SIZE)
+        logging.basicConfig(level=log_level, format=log_format, handlers=[console_handler, ring_handler])
+    else:
+        # La scrittura su console avviene nel thread del QueueListener: il ciclo letture accoda solo il record
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(log_format))
+        log_queue = queue.SimpleQueue()
+        log_listener = QueueListener(log_queue, console_handler)
+        root_logger = logging.getLogger()
+        root_logger.setLevel(log_level)
+        root_logger.addHandler(QueueHandler(log_queue))
+        log_listener.start()
+
     CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conf','patient_config.json')
 
     initial_glucose = Config.SIM_SENSOR_START_VALUE
@@ -144,6 +399,13 @@ if __name__ == "__main__":
     try:
         patient = PatientDescriptor.from_json_file(CONFIG_FILE_PATH)
         sensor = GlucoseSensorProducerSenML(sensor_id, patient.patient_id, initial_glucose, simulation_mode)
+        if "--dedupe" in sys.argv:
+            sensor.dedupe = True
         sensor.run_continuous()
     except Exception as e:
-        print(f"❌ Errore avvio: {e}")
\ No newline at end of file
+        print(f"❌ Errore avvio: {e}")
+    finally:
+        if ring_handler is not None:
+            ring_handler.flush_to()
+        if log_listener is not None:
+            log_listener.stop()
\ No newline at end of file
@@ -2,18 +2,42 @@ import paho.mqtt.client as mqtt
 import time
 import sys
 import os
+import json
 import threading
-
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from model.insulin_pump_data import InsulinPumpStatus
 from model.patient_descriptor import PatientDescriptor
 from conf.SystemConfiguration import SystemConfig as Config
-from utils.senml_helper import SenMLHelper
+from utils.senml_helper import SenMLHelper, ORJSON_AVAILABLE
+from utils.mqtt_socket import enable_tcp_nodelay
+
+# Modalità soggette al limite di sicurezza sul singolo bolo
+BOLUS_MODES = frozenset(("bolus", "correction"))
 
 class InsulinPumpActuatorSenML:
+    __slots__ = (
+        "pump_id", "patient_id", "log", "status",
+        "broker_address", "broker_port", "client",
+        "base_topic", "command_topic", "status_topic", "alert_topic", "_alert_template",
+        "status_interval", "status_refresh_every", "_last_status_key", "_status_skipped",
+        "max_single_bolus", "max_basal_rate",
+        "_qos_status", "_retain_status", "_qos_notif",
+        "command_history", "_total_commands", "_total_insulin",
+        "_stop_event", "_delivery_queue", "_delivery_thread", "_status_lock",
+    )
+
     def __init__(self, pump_id, patient_id, initial_insulin=None, initial_battery=None):
         self.pump_id = pump_id
         self.patient_id = patient_id
+        self.log = logging.getLogger("insulin_pump")
 
         self.status = InsulinPumpStatus(
             pump_id,
@@ -26,6 +50,7 @@ class InsulinPumpActuatorSenML:
         self.broker_address = Config.BROKER_ADDRESS
         self.broker_port = Config.BROKER_PORT
         self.client = mqtt.Client(f"insulin_pump_senml_{pump_id}")
+        self.client.max_inflight_messages_set(Config.MQTT_MAX_INFLIGHT_MESSAGES)
 
         # Topic MQTT
         self.base_topic = f"/iot/patient/{patient_id}"
@@ -33,23 +58,55 @@ class InsulinPumpActuatorSenML:
         self.status_topic = f"{self.base_topic}/insulin/pump/status"
         self.alert_topic = f"{self.base_topic}/notifications/alert"
 
+        # Senza orjson (e in JSON) alert pre-codificato come nel Data Collector: record senza
+        # parentesi, concatenabili in un pacchetto; con orjson o CBOR si usano i record di SenMLHelper
+        self._alert_template = None
+        if not ORJSON_AVAILABLE and not Config.SENML_CBOR_ENABLED:
+            alert_base_name = json.dumps(f"urn:patient:{patient_id}:alert:").replace("%", "%%")
+            self._alert_template = (
+                '{"bn":' + alert_base_name + ',"bt":%r},'
+                '{"n":"type","vs":%s,"t":0},'
+                '{"n":"message","vs":%s,"t":0},'
+                '{"n":"severity","vs":%s,"t":0}'
+            ).encode()
+
         # Intervallo pubblicazione status
         self.status_interval = Config.PUMP_STATUS_INTERVAL
+        # Ultimo status pubblicato (chiave arrotondata) e intervalli trascorsi senza ripubblicarlo
+        self.status_refresh_every = Config.PUMP_STATUS_REFRESH_EVERY
+        self._last_status_key = None
+        self._status_skipped = 0
 
         # Parametri di sicurezza
         self.max_single_bolus = Config.SAFETY_MAX_BOLUS_U
         self.max_basal_rate = Config.SAFETY_MAX_BASAL_RATE_UH
 
-        # Log comandi ricevuti
-        self.command_history = []
+        # QoS e retain usati a ogni pubblicazione, letti una sola volta dalla configurazione
+        self._qos_status = Config.QOS_SENSOR_DATA
+        self._retain_status = Config.RETAIN_PUMP_STATUS
+        self._qos_notif = Config.QOS_NOTIFICATIONS
+
+        # Log comandi eseguiti (coda circolare) e totali cumulativi
+        self.command_history = deque(maxlen=Config.PUMP_COMMAND_HISTORY_LIMIT)
+        self._total_commands = 0
+        self._total_insulin = 0.0
 
-        # Thread per pubblicazione status periodico
-        self.status_thread = None
-        self.running = False
+        # Lo status periodico è pubblicato dal thread principale; stop() lo risveglia subito
+        self._stop_event = threading.Event()
+
+        # Erogazioni eseguite da un thread dedicato: on_command (thread di rete paho) valida,
+        # invia l'ACK e accoda, senza restare bloccato per la durata simulata dell'erogazione
+        # (coda limitata: oltre PUMP_DELIVERY_QUEUE_SIZE comandi in attesa la pompa li rifiuta come occupata)
+        self._delivery_queue = queue.Queue(maxsize=Config.PUMP_DELIVERY_QUEUE_SIZE)
+        self._delivery_thread = threading.Thread(target=self._delivery_worker, name="insulin_pump_delivery", daemon=True)
+        # Status condiviso tra thread principale (status periodico), thread di rete e thread erogazioni
+        self._status_lock = threading.Lock()
 
         # Configurazione callbacks
+        self.client.on_socket_open = enable_tcp_nodelay
         self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        # Unico topic sottoscritto: paho instrada i comandi direttamente a on_command
+        self.client.message_callback_add(self.command_topic, self.on_command)
         self.client.on_disconnect = self.on_disconnect
 
     def on_connect(self, client, userdata, flags, rc):
@@ -60,7 +117,7 @@ class InsulinPumpActuatorSenML:
             print(f"📤 Pubblicazione status su: {self.status_topic}")
 
             client.subscribe(self.command_topic, qos=Config.QOS_COMMANDS)
-            self.publish_status()
+            self.publish_status(force=True)
             print("🎯 Pompa pronta per ricevere comandi SenML...")
         else:
             print(f"❌ Connessione fallita con codice: {rc}")
@@ -69,35 +126,30 @@ class InsulinPumpActuatorSenML:
         if rc != 0:
             print(f"⚠️ Disconnessione imprevista dal broker (rc: {rc})")
 
-    def on_message(self, client, userdata, msg):
+    def on_command(self, client, userdata, msg):
         try:
-            if "insulin/pump/command" in msg.topic:
-                self.process_senml_command(msg.payload.decode())
+            self.process_senml_command(msg.payload)
         except Exception as e:
-            print(f"❌ Errore nell'elaborazione del messaggio: {e}")
+            self.log.error("❌ Errore nell'elaborazione del messaggio: %s", e)
 
-    def parse_senml_command(self, senml_json):
+    def parse_senml_command(self, senml_payload):
         try:
-            parsed = SenMLHelper.parse_senml(senml_json)
+            parsed = SenMLHelper.parse_senml(senml_payload)
             measurements = parsed.get('measurements', {})
 
             return {
-                'insulin_amount': measurements.get('dose', {}).get('value', 0.0),
-                'delivery_mode': measurements.get('type', {}).get('value', 'bolus'),
-                'command_id': measurements.get('command_id', {}).get('value', 'unknown'),
-                'priority': measurements.get('priority', {}).get('value', 'normal'),
-                'reason': measurements.get('reason', {}).get('value', 'N/A'),
-                'timestamp': parsed.get('base_time', time.time())
+                'insulin_amount': measurements.get('dose', 0.0),
+                'delivery_mode': measurements.get('type', 'bolus'),
+                'command_id': measurements.get('command_id', 'unknown'),
+                'priority': measurements.get('priority', 'normal'),
+                'reason': measurements.get('reason', 'N/A'),
+                'timestamp': parsed.get('base_time') or time.time()
             }
         except Exception as e:
-            print(f"❌ Errore nel parsing comando SenML: {e}")
+            self.log.error("❌ Errore nel parsing comando SenML: %s", e)
             return None
 
     def process_senml_command(self, senml_payload):
-        print("\n" + "=" * 60)
-        print("** NUOVO COMANDO SENML RICEVUTO **")
-        print("=" * 60)
-
         try:
             command_data = self.parse_senml_command(senml_payload)
             if command_data is None:
@@ -107,9 +159,7 @@ class InsulinPumpActuatorSenML:
             delivery_mode = command_data['delivery_mode']
             insulin_amount = command_data['insulin_amount']
 
-            print(f"🆔 Command ID: {command_id}")
-            print(f"💉 Modalità: {delivery_mode}")
-            print(f"📊 Quantità: {insulin_amount:.2f} unità")
+            self.log.info("💉 Comando %s ricevuto | %s | %.2fU", command_id, delivery_mode, insulin_amount)
 
             # Controlli (Stato, Insulina, Sicurezza)
             if self.status.pump_status != "active":
@@ -120,132 +170,229 @@ class InsulinPumpActuatorSenML:
                 self.send_senml_alert("ERROR", f"Insulina insufficiente per comando {command_id}", "critical")
                 return False
 
-            if delivery_mode in ["bolus", "correction"]:
-                if insulin_amount > self.max_single_bolus:
-                    self.send_senml_alert("ERROR", f"Dose {insulin_amount:.2f}U supera limite sicurezza", "critical")
-                    return False
+            if insulin_amount > self.max_single_bolus and delivery_mode in BOLUS_MODES:
+                self.send_senml_alert("ERROR", f"Dose {insulin_amount:.2f}U supera limite sicurezza", "critical")
+                return False
+
+            # Unico produttore è questo callback: se la coda non è piena, put_nowait non può fallire
+            if self._delivery_queue.full():
+                self.send_senml_alert("ERROR", f"Comando {command_id} rifiutato: pompa occupata", "high")
+                return False
 
             self.send_senml_alert("PUMP_ACK",
                                   f"Ricevuto cmd {command_id}. Erogazione {insulin_amount:.2f}U ({delivery_mode})",
                                   "low")
 
-            # ESEGUI
-            success = self.execute_delivery(delivery_mode, insulin_amount)
-
-            if success:
-                print(f"✅ Comando eseguito con successo!")
-                self.command_history.append({
-                    'timestamp': time.time(),
-                    'command_id': command_id,
-                    'delivery_mode': delivery_mode,
-                    'amount': insulin_amount
-                })
-                self.publish_status()
-                self.send_senml_alert("INFO", f"Erogazione completata: {insulin_amount:.2f}U ({delivery_mode})", "low")
-
-            print("=" * 60 + "\n")
-            return success
+            # ESEGUI (nel thread erogazioni)
+            self._delivery_queue.put_nowait((command_id, delivery_mode, insulin_amount))
+            return True
 
         except Exception as e:
-            print(f"❌ Errore nel processamento comando: {e}")
+            self.log.error("❌ Errore nel processamento comando: %s", e)
             return False
 
+    def _delivery_worker(self):
+        """
+        Thread erogazioni: esegue i comandi accodati in ordine fino alla sentinella None.
+        I comandi arrivati durante un'erogazione vengono eseguiti di seguito e chiusi da un solo
+        status e un solo pacchetto di alert di completamento.
+        """
+        running = True
+        while running:
+            job = self._delivery_queue.get()
+            completed = []
+            while job is not None:
+                alert = self._run_delivery(*job)
+                if alert is not None:
+                    completed.append(alert)
+                try:
+                    job = self._delivery_queue.get_nowait()
+                except queue.Empty:
+                    break
+            running = job is not None
+
+            if completed:
+                self.publish_status(force=True)
+                self.client.publish(self.alert_topic, self._encode_alerts(completed), qos=self._qos_notif)
+
+    def _run_delivery(self, command_id, delivery_mode, insulin_amount):
+        """Esegue un comando accodato; restituisce l'alert di completamento o None se non eseguito"""
+        try:
+            if not self.execute_delivery(delivery_mode, insulin_amount):
+                return None
+
+            self.log.info("✅ Comando %s eseguito", command_id)
+            now = time.time()
+            self.command_history.append({
+                'timestamp': now,
+                'command_id': command_id,
+                'delivery_mode': delivery_mode,
+                'amount': insulin_amount
+            })
+            self._total_commands += 1
+            self._total_insulin += insulin_amount
+            return self._build_alert("INFO", f"Erogazione completata: {insulin_amount:.2f}U ({delivery_mode})", "low", now)
+        except Exception as e:
+            self.log.error("❌ Errore nell'esecuzione del comando %s: %s", command_id, e)
+            return None
+
     def execute_delivery(self, delivery_mode, amount):
         """Simula l'erogazione di insulina con tempi realistici (da Config)"""
-        try:
-            print(f"\n💉 Inizio erogazione...")
+        handler = self._DELIVERY_HANDLERS.get(delivery_mode)
+        if handler is None:
+            return False
 
+        try:
             # Calcola tempo erogazione
             delivery_time = amount * Config.SIM_PUMP_DELIVERY_SEC_PER_UNIT
-            print(f"⏱️  Tempo stimato: {delivery_time:.1f}s")
+            self.log.debug("Erogazione %.2fU, tempo stimato %.1fs", amount, delivery_time)
 
             # Simula attesa (bloccante ma limitata per non freezare il thread troppo a lungo)
             wait_time = min(delivery_time, Config.SIM_PUMP_DELIVERY_MAX_WAIT_S)
             time.sleep(wait_time)
 
-            if delivery_mode in ["bolus", "correction"]:
-                return self.status.deliver_bolus(amount, delivery_mode)
+            with self._status_lock:
+                return handler(self, delivery_mode, amount)
 
-            elif delivery_mode == "basal":
-                if amount <= self.max_basal_rate:
-                    self.status.current_basal_rate = amount
-                    return True
-                return False
+        except Exception as e:
+            self.log.error("❌ Errore durante erogazione: %s", e)
+            return False
 
-            elif delivery_mode == "emergency_stop":
-                self.status.current_basal_rate = 0.0
-                return True
+    # Handler per modalità di erogazione (chiamati da execute_delivery con _status_lock acquisito)
+    def _deliver_bolus(self, delivery_mode, amount):
+        return self.status.deliver_bolus(amount, delivery_mode)
 
-            return False
+    def _deliver_basal(self, delivery_mode, amount):
+        if amount <= self.max_basal_rate:
+            self.status.current_basal_rate = amount
+            return True
+        return False
 
-        except Exception as e:
-            print(f"❌ Errore durante erogazione: {e}")
-            return False
+    def _deliver_emergency_stop(self, delivery_mode, amount):
+        self.status.current_basal_rate = 0.0
+        return True
+
+    _DELIVERY_HANDLERS = {
+        "bolus": _deliver_bolus,
+        "correction": _deliver_bolus,
+        "basal": _deliver_basal,
+        "emergency_stop": _deliver_emergency_stop,
+    }
 
     def create_senml_status(self):
         return self.status.to_senml()
 
-    def publish_status(self):
+    def publish_status(self, force=False):
+        """
+        Aggiorna lo status simulato e lo pubblica se è cambiato in modo rilevante
+        (o se force, o dopo status_refresh_every intervalli invariati)
+        """
         try:
-            self.status.update_status()
-            status_senml = self.create_senml_status()
-
-            self.client.publish(
-                self.status_topic,
-                status_senml,
-                qos=Config.QOS_SENSOR_DATA,
-                retain=Config.RETAIN_PUMP_STATUS
-            )
-
-            if self.status.has_critical_alarms():
-                for alarm in self.status.active_alarms:
-                    self.send_senml_alert("PUMP_ALARM", f"🚨 ALLARME CRITICO: {alarm}", "critical")
+            with self._status_lock:
+                status = self.status
+                status.update_status()
+
+                key = (round(status.insulin_reservoir_level), round(status.battery_level), status.pump_status,
+                       status.active_alarms, status.current_basal_rate)
+                if force or key != self._last_status_key or self._status_skipped + 1 >= self.status_refresh_every:
+                    result = self.client.publish(
+                        self.status_topic,
+                        self.create_senml_status(),
+                        qos=self._qos_status,
+                        retain=self._retain_status
+                    )
+                    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                        self.log.error("❌ Errore pubblicazione status (rc: %s)", result.rc)
+                    self._last_status_key = key
+                    self._status_skipped = 0
+                else:
+                    self._status_skipped += 1
+
+                if status.has_critical_alarms():
+                    # Tutti gli allarmi critici in un unico pacchetto SenML (un alert per allarme)
+                    now = time.time()
+                    alerts = [self._build_alert("PUMP_ALARM", f"🚨 ALLARME CRITICO: {alarm}", "critical", now)
+                              for alarm in status.active_alarms]
+                    self.client.publish(self.alert_topic, self._encode_alerts(alerts), qos=self._qos_notif)
 
             return True
         except Exception as e:
-            print(f"❌ Errore pubblicazione status: {e}")
+            self.log.error("❌ Errore pubblicazione status: %s", e)
             return False
 
     def send_senml_alert(self, alert_type, message, severity="medium"):
         try:
-            alert_senml = SenMLHelper.create_notification_alert(
-                patient_id=self.patient_id,
-                alert_type=alert_type,
-                message=message,
-                severity=severity
-            )
-            self.client.publish(self.alert_topic, alert_senml, qos=Config.QOS_NOTIFICATIONS)
+            alert = self._build_alert(alert_type, message, severity, time.time())
+            self.client.publish(self.alert_topic, self._encode_alerts([alert]), qos=self._qos_notif)
         except Exception:
             pass
 
+    def _build_alert(self, alert_type, message, severity, now):
+        """Un alert: frammento JSON da _alert_template, oppure lista di record (orjson/CBOR)"""
+        if self._alert_template is None:
+            return SenMLHelper.notification_alert_records(self.patient_id, alert_type, message, severity, now)
+        return self._alert_template % (
+            now,
+            SenMLHelper.json_bytes(alert_type),
+            SenMLHelper.json_bytes(message),
+            SenMLHelper.enum_json(severity)
+        )
+
+    def _encode_alerts(self, alerts):
+        """Serializza gli alert di _build_alert in un unico pacchetto SenML"""
+        if self._alert_template is None:
+            return SenMLHelper.encode_senml([record for records in alerts for record in records])
+        return b"[" + b",".join(alerts) + b"]"
+
+    def get_statistics(self):
+        return {
+            'total_commands_executed': self._total_commands,
+            'total_insulin_delivered': self._total_insulin,
+            'insulin_reservoir': self.status.insulin_reservoir_level,
+            'battery_level': self.status.battery_level
+        }
+
     def status_publisher_loop(self):
-        while self.running:
+        """Pubblica lo status a scadenze fisse fino a stop(), senza thread dedicato né polling"""
+        next_publish = time.monotonic()
+        while not self._stop_event.is_set():
             self.publish_status()
-            time.sleep(self.status_interval)
+            next_publish += self.status_interval
+            self._stop_event.wait(max(0.0, next_publish - time.monotonic()))
 
     def start(self):
         try:
             print(f"🚀 AVVIO POMPA (ID: {self.pump_id})")
             self.client.connect(self.broker_address, self.broker_port, Config.MQTT_KEEPALIVE_S)
             self.client.loop_start()
+            self._delivery_thread.start()
 
-            self.running = True
-            self.status_thread = threading.Thread(target=self.status_publisher_loop)
-            self.status_thread.daemon = True
-            self.status_thread.start()
-
-            while self.running:
-                time.sleep(1)
+            self.status_publisher_loop()
         except KeyboardInterrupt:
             self.stop()
 
     def stop(self):
-        self.running = False
+        self._stop_event.set()
+        if self._delivery_thread.is_alive():
+            # Sentinella: le erogazioni già accodate vengono completate prima della chiusura
+            self._delivery_queue.put(None)
+            self._delivery_thread.join()
         self.client.loop_stop()
         self.client.disconnect()
 
 
 if __name__ == "__main__":
+    # La scrittura su console avviene nel thread del QueueListener: thread di rete paho,
+    # thread erogazioni e status periodico accodano solo il record
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, console_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(Config.PUMP_LOG_LEVEL)
+    root_logger.addHandler(QueueHandler(log_queue))
+    log_listener.start()
+
     CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conf','patient_config.json')
 
     pump_id = 'pump_001'
@@ -257,4 +404,6 @@ if __name__ == "__main__":
         pump = InsulinPumpActuatorSenML(pump_id, patient.patient_id, initial_insulin, initial_battery)
         pump.start()
     except Exception as e:
-        print(f"❌ Errore avvio: {e}")
\ No newline at end of file
+        print(f"❌ Errore avvio: {e}")
+    finally:
+        log_listener.stop()
\ No newline at end of file
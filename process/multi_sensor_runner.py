@@ -0,0 +1,142 @@
+import paho.mqtt.client as mqtt
+import time
+import sys
+import os
+import random
+import logging
+
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.glucose_sensor_data import GlucoseSensorData
+from model.glucose_simulation_logic import GlucoseSimulationLogic
+from conf.SystemConfiguration import SystemConfig as Config
+from utils.senml_helper import SenMLHelper
+from utils.mqtt_socket import enable_tcp_nodelay
+
+
+class SimulatedSensor:
+    """Stato di un sensore simulato gestito dal MultiSensorRunner (nessun client MQTT proprio)"""
+
+    def __init__(self, patient_id, simulation_mode, rng):
+        self.patient_id = patient_id
+        self.simulation_mode = simulation_mode
+        self.variation = GlucoseSimulationLogic.variation_for_mode(simulation_mode)
+        self.sensor = GlucoseSensorData(f"sensor_{patient_id}", patient_id,
+                                        glucose_value=Config.SIM_SENSOR_START_VALUE)
+        self.active_insulin_doses = []
+        self.rng = rng
+
+        base_topic = f"/iot/patient/{patient_id}"
+        self.publish_topic = f"{base_topic}/glucose/sensor/data"
+        self.command_topic = f"{base_topic}/insulin/pump/command"
+
+
+class MultiSensorRunner:
+    """
+    Esegue N sensori glicemia simulati in un solo processo per i test di scalabilità:
+    un unico client MQTT (una connessione TCP, un loop di rete) e un unico ciclo
+    a scadenze che a ogni intervallo genera e pubblica la lettura di ciascun sensore.
+    """
+
+    def __init__(self, patient_ids, modes=None):
+        self.log = logging.getLogger("multi_sensor_runner")
+        self.broker_address = Config.BROKER_ADDRESS
+        self.broker_port = Config.BROKER_PORT
+        self.client = mqtt.Client(f"multi_sensor_runner_{os.getpid()}")
+        self.reading_interval = Config.GLUCOSE_READING_INTERVAL
+        self.insulin_sensitivity_factor = Config.INSULIN_CORRECTION_FACTOR
+
+        modes = modes or ["normal"]
+        rng = random.Random()
+        self.sensors = [SimulatedSensor(patient_id, modes[i % len(modes)], rng)
+                        for i, patient_id in enumerate(patient_ids)]
+
+        # Un callback per topic comando: instradamento diretto al sensore del paziente
+        for sim in self.sensors:
+            self.client.message_callback_add(sim.command_topic, self._command_callback(sim))
+
+        self.client.on_socket_open = enable_tcp_nodelay
+        self.client.on_connect = self.on_connect
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print(f"✅ Multi Sensor Runner connesso ({len(self.sensors)} sensori)")
+            # Un solo pacchetto SUBSCRIBE per tutti i topic comando
+            client.subscribe([(sim.command_topic, Config.QOS_COMMANDS) for sim in self.sensors])
+        else:
+            print(f"❌ Connessione fallita: rc={rc}")
+
+    def _command_callback(self, sim):
+        def on_command(client, userdata, msg):
+            try:
+                data = SenMLHelper.parse_senml(msg.payload).get("measurements", {})
+                dose = data.get("dose", 0.0)
+                if dose > 0 and data.get("type", "bolus") in ["bolus", "correction"]:
+                    sim.active_insulin_doses.append({'amount': dose, 'start_time': time.time()})
+                    self.log.info("💉 %s: Rilevata insulina %.2fU", sim.patient_id, dose)
+            except Exception as e:
+                self.log.error("❌ Errore comando sensore %s: %s", sim.patient_id, e)
+        return on_command
+
+    def tick(self, sensors=None):
+        """Genera e pubblica una lettura per ciascun sensore simulato (o solo per quelli indicati)"""
+        now = time.time()
+        interval = self.reading_interval
+        isf = self.insulin_sensitivity_factor
+        publish = self.client.publish
+        qos = Config.QOS_SENSOR_TELEMETRY
+
+        for sim in sensors if sensors is not None else self.sensors:
+            sensor = sim.sensor
+            variation = sim.variation(sim.rng.random)
+            if sim.active_insulin_doses:
+                variation += GlucoseSimulationLogic.calculate_insulin_effect(
+                    sim.active_insulin_doses, isf, now, interval)
+            sensor.apply_variation(variation, interval, sim.rng, now)
+            # Nessun controllo sul percorso di successo: si registra solo il fallimento
+            rc = publish(sim.publish_topic, sensor.to_senml(), qos=qos).rc
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                self.log.warning("⚠️ %s: pubblicazione fallita (rc: %s)", sim.patient_id, rc)
+
+    def run_continuous(self):
+        try:
+            print(f"🚀 AVVIO MULTI SENSOR RUNNER ({len(self.sensors)} sensori)")
+            self.client.connect(self.broker_address, self.broker_port, Config.MQTT_KEEPALIVE_S)
+            self.client.loop_start()
+
+            # Sensori sfalsati: a ogni sotto-scadenza si pubblica un gruppo, ogni sensore resta a una lettura per intervallo
+            slot_count = max(1, min(len(self.sensors), Config.MULTI_SENSOR_SLOTS))
+            slots = [self.sensors[i::slot_count] for i in range(slot_count)]
+            slot_interval = self.reading_interval / slot_count
+            max_lag = Config.SENSOR_MAX_LAG_INTERVALS * self.reading_interval
+            next_tick = time.monotonic()
+            while True:
+                for slot in slots:
+                    self.tick(slot)
+                    next_tick += slot_interval
+                    delay = next_tick - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif -delay > max_lag:
+                        self.log.warning("⚠️ Ciclo in ritardo di %.2fs con %d sensori", -delay, len(self.sensors))
+                        next_tick = time.monotonic()
+
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=Config.SENSOR_LOG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
+
+    # Uso: python multi_sensor_runner.py [numero_sensori]
+    sensor_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    patient_ids = [f"patient_{i:03d}" for i in range(1, sensor_count + 1)]
+
+    runner = MultiSensorRunner(patient_ids, ["normal", "hyperglycemia", "hypoglycemia", "fluctuating"])
+    runner.run_continuous()
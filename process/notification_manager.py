@@ -3,32 +3,42 @@ import sys
 import os
 import time
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Radice del progetto nel path solo se eseguito come script (python process/x.py);
+# importato come modulo del package (o con python -m) è già raggiungibile
+if not __package__:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from conf.SystemConfiguration import SystemConfig as Config
 from utils.senml_helper import SenMLHelper
 from model.patient_descriptor import PatientDescriptor
 
+SEVERITY_EMOJI = {"low": "ℹ️", "medium": "⚠️", "high": "🔶", "critical": "🚨", "emergency": "🛑"}
+SEPARATOR = "=" * 50
+
 
 class NotificationManager:
     """
     Componente che si occupa solo di ricevere e loggare gli alert/notifiche
     inviate dal Data Collector o dalla Pompa.
+    Con patient_id=None segue tutti i pazienti con un'unica sottoscrizione wildcard.
     """
 
-    def __init__(self, patient_id):
+    def __init__(self, patient_id=None):
         self.patient_id = patient_id
         self.broker_address = Config.BROKER_ADDRESS
         self.broker_port = Config.BROKER_PORT
-        self.client = mqtt.Client(f"notification_manager_{patient_id}")
+        self.client = mqtt.Client(f"notification_manager_{patient_id or 'all'}")
 
-        # Topic alert
-        self.base_topic = f"/iot/patient/{patient_id}"
+        # Topic alert (paziente ricavato dal topic: /iot/patient/<id>/notifications/alert)
+        self.base_topic = f"/iot/patient/{patient_id or '+'}"
         self.alert_topic = f"{self.base_topic}/notifications/alert"
 
+        # Ultimo secondo formattato: gli alert dello stesso pacchetto/secondo riusano la stringa
+        self._last_sec = None
+        self._last_timestamp = ""
+
         # Configurazione callbacks
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
-        self.severity_emoji = {"low": "ℹ️", "medium": "⚠️", "high": "🔶", "critical": "🚨", "emergency": "🛑"}
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -41,30 +51,40 @@ class NotificationManager:
     def on_message(self, client, userdata, msg):
         """Callback quando arriva un alert SenML"""
         try:
-            payload = msg.payload.decode()
-            parsed = SenMLHelper.parse_senml(payload)
-            measurements = parsed.get("measurements", {})
-
-            alert_type = measurements.get("type", {}).get("value", "UNKNOWN")
-            message = measurements.get("message", {}).get("value", "N/A")
-            severity = measurements.get("severity", {}).get("value", "medium")
-            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(parsed.get("base_time")))
-            emoji = self.severity_emoji.get(severity, "📢")
-
-            print("\n" + "=" * 50)
-            print(f"{emoji} {timestamp} | NUOVA NOTIFICA RICEVUTA")
-            print(f"Tipo: {alert_type} | Gravità: {severity.upper()}")
-            print(f"Messaggio: {message}")
-            print("=" * 50)
+            patient_id = msg.topic.split("/", 4)[3]
+            # Un pacchetto può contenere più alert concatenati
+            for parsed in SenMLHelper.parse_senml_pack(msg.payload):
+                measurements = parsed.get("measurements", {})
+
+                alert_type = measurements.get("type", "UNKNOWN")
+                message = measurements.get("message", "N/A")
+                severity = measurements.get("severity", "medium")
+                timestamp = self._format_time(parsed.get("base_time"))
+                emoji = SEVERITY_EMOJI.get(severity, "📢")
+
+                # Banner in un'unica scrittura su stdout
+                print(f"\n{SEPARATOR}\n"
+                      f"{emoji} {timestamp} | NUOVA NOTIFICA RICEVUTA\n"
+                      f"Paziente: {patient_id} | Tipo: {alert_type} | Gravità: {severity.upper()}\n"
+                      f"Messaggio: {message}\n"
+                      f"{SEPARATOR}")
 
         except Exception as e:
             print(f"❌ Errore nell'elaborazione alert SenML: {e}")
 
+    def _format_time(self, base_time):
+        """Timestamp leggibile dell'alert; strftime solo quando cambia il secondo"""
+        sec = int(base_time) if base_time is not None else int(time.time())
+        if sec != self._last_sec:
+            self._last_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+            self._last_sec = sec
+        return self._last_timestamp
+
     def start(self):
         """Avvia il Notification Manager"""
         try:
             print("\n" + "=" * 60)
-            print(f"🚀 AVVIO NOTIFICATION MANAGER (Paziente: {self.patient_id})")
+            print(f"🚀 AVVIO NOTIFICATION MANAGER (Paziente: {self.patient_id or 'tutti'})")
             print("=" * 60)
             self.client.connect(self.broker_address, self.broker_port, 60)
             self.client.loop_forever()
@@ -78,12 +98,15 @@ class NotificationManager:
 if __name__ == "__main__":
     CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'conf','patient_config.json')
 
-    try:
-        patient = PatientDescriptor.from_json_file(CONFIG_FILE_PATH)
-        patient_id = patient.patient_id
-    except Exception as e:
-        print(f"❌ Errore di caricamento configurazione: {e}")
-        sys.exit(1)
+    # Uso: python notification_manager.py [--all]  (--all: alert di tutti i pazienti)
+    patient_id = None
+    if "--all" not in sys.argv:
+        try:
+            patient = PatientDescriptor.from_json_file(CONFIG_FILE_PATH)
+            patient_id = patient.patient_id
+        except Exception as e:
+            print(f"❌ Errore di caricamento configurazione: {e}")
+            sys.exit(1)
 
     manager = NotificationManager(patient_id)
     manager.start()
\ No newline at end of file
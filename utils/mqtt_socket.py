@@ -0,0 +1,18 @@
+import socket
+
+from conf.SystemConfiguration import SystemConfig as Config
+
+
+def enable_tcp_nodelay(client, userdata, sock):
+    """
+    Callback on_socket_open di paho: disabilita l'algoritmo di Nagle sul socket
+    appena aperto (anche dopo ogni riconnessione), così i piccoli pacchetti SenML
+    partono subito invece di attendere l'ACK del segmento precedente.
+    """
+    if not Config.MQTT_TCP_NODELAY:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        # Socket non TCP (es. websocket/proxy): si mantengono le opzioni di default
+        pass
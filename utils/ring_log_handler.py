@@ -0,0 +1,27 @@
+import collections
+import logging
+import sys
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Handler di logging che conserva in memoria solo gli ultimi `capacity` messaggi
+    formattati, senza scrivere su stdout a ogni record; flush_to() li emette
+    tutti insieme (es. all'arresto del processo).
+    """
+
+    def __init__(self, capacity=256):
+        super().__init__()
+        self.ring = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        try:
+            self.ring.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush_to(self, stream=None):
+        """Scrive il contenuto del buffer con una sola write e lo svuota."""
+        if self.ring:
+            (stream or sys.stdout).write("\n".join(self.ring) + "\n")
+            self.ring.clear()
@@ -1,6 +1,69 @@
 import json
 import time
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, List, Union
+from conf.SystemConfiguration import SystemConfig as Config
+
+try:
+    import cbor2  # Supporto opzionale SenML-CBOR
+except ImportError:
+    cbor2 = None
+
+try:
+    import orjson  # Serializzatore JSON opzionale (estensione C)
+except ImportError:
+    orjson = None
+
+# Con orjson la serializzazione dei record è più rapida di qualsiasi template formattato in Python
+ORJSON_AVAILABLE = orjson is not None
+
+# Etichette intere della rappresentazione SenML-CBOR (RFC 8428, Tabella 6)
+SENML_CBOR_LABELS = {
+    "bver": -1, "bn": -2, "bt": -3, "bu": -4, "bv": -5, "bs": -6,
+    "n": 0, "u": 1, "v": 2, "vs": 3, "vb": 4, "s": 5, "t": 6, "ut": 7, "vd": 8
+}
+SENML_CBOR_NAMES = {label: name for name, label in SENML_CBOR_LABELS.items()}
+
+
+# Valori enumerati dei campi stringa (gravità alert, modalità e priorità dei comandi)
+NOTIFICATION_SEVERITIES = frozenset(("low", "medium", "high", "critical", "emergency"))
+DELIVERY_MODES = frozenset(("bolus", "correction", "basal", "emergency_stop"))
+COMMAND_PRIORITIES = frozenset(("normal", "high", "emergency"))
+
+# Forma JSON già serializzata dei valori enumerati, da inserire nei template pre-codificati
+_ENUM_JSON = {value: json.dumps(value).encode()
+              for value in NOTIFICATION_SEVERITIES | DELIVERY_MODES | COMMAND_PRIORITIES}
+
+
+@lru_cache(maxsize=1024)
+def _base_name(patient_id: str, *kind: str) -> str:
+    """Base name SenML (urn:patient:<id>:<kind...>:), costruito una volta per paziente/tipo"""
+    return ":".join(("urn:patient", patient_id) + kind) + ":"
+
+
+class GlucoseReading:
+    """
+    Lettura glicemica estratta una sola volta dalle misure SenML del sensore
+    (accesso ad attributo invece di lookup ripetuti sul dizionario)
+    """
+    __slots__ = ("level", "trend", "status", "trend_rate", "battery")
+
+    def __init__(self, level: float, trend: str, status: str, trend_rate: float, battery: float):
+        self.level = level
+        self.trend = trend
+        self.status = status
+        self.trend_rate = trend_rate
+        self.battery = battery
+
+    @classmethod
+    def from_measurements(cls, measurements: Dict[str, Any]) -> "GlucoseReading":
+        return cls(
+            level=measurements.get("level"),
+            trend=measurements.get("trend", "stable"),
+            status=measurements.get("status", "unknown"),
+            trend_rate=measurements.get("trend_rate", 0.0),
+            battery=measurements.get("battery", 100.0)
+        )
 
 class SenMLHelper:
     """
@@ -15,7 +78,7 @@ class SenMLHelper:
                                         sensor_status: str = "active",
                                         confidence_level: float = 1.0,
                                         calibration_needed: bool = False,
-                                        timestamp: float = None) -> str:
+                                        timestamp: float = None) -> bytes:
         """
         Crea un messaggio SenML completo con tutti i dati del sensore glicemia
         Args:
@@ -31,14 +94,35 @@ class SenMLHelper:
             confidence_level: Livello di confidenza del dato (0-1)
             timestamp: Timestamp UNIX (se None, usa tempo corrente)
         Returns:
-            Stringa JSON in formato SenML con tutti i dati del sensore
+            Payload SenML (bytes, vedi encode_senml) con tutti i dati del sensore
+        """
+        return SenMLHelper.encode_senml(SenMLHelper.glucose_sensor_records(
+            patient_id, sensor_id, glucose_value, glucose_status, trend_direction, trend_rate,
+            battery_level, signal_strength, sensor_status, confidence_level, calibration_needed, timestamp
+        ))
+
+    @staticmethod
+    def glucose_sensor_records(patient_id: str, sensor_id: str,
+                               glucose_value: float, glucose_status: str,
+                               trend_direction: str, trend_rate: float,
+                               battery_level: float, signal_strength: int,
+                               sensor_status: str = "active",
+                               confidence_level: float = 1.0,
+                               calibration_needed: bool = False,
+                               timestamp: float = None) -> List[Dict[str, Any]]:
+        """
+        Crea i record SenML di una lettura del sensore senza serializzarli, così che
+        più letture possano essere inviate in un unico pacchetto (vedi parse_senml_pack)
+
+        Returns:
+            Lista di record SenML
         """
         if timestamp is None:
             timestamp = time.time()
 
-        base_name = f"urn:patient:{patient_id}:sensor:{sensor_id}:glucose:"
+        base_name = _base_name(patient_id, "sensor", sensor_id, "glucose")
 
-        senml_record = [
+        return [
             {
                 "bn": base_name,
                 "bt": timestamp,
@@ -91,11 +175,9 @@ class SenMLHelper:
             }
         ]
 
-        return json.dumps(senml_record)
-
     @staticmethod
     def create_insulin_command(patient_id: str, units: float,
-                               command_type: str = "bolus", timestamp: float = None) -> str:
+                               command_type: str = "bolus", timestamp: float = None) -> bytes:
         """
         Crea un comando SenML per la pompa di insulina
 
@@ -106,12 +188,12 @@ class SenMLHelper:
             timestamp: Timestamp UNIX
 
         Returns:
-            Stringa JSON in formato SenML
+            Payload SenML (bytes, vedi encode_senml)
         """
         if timestamp is None:
             timestamp = time.time()
 
-        base_name = f"urn:patient:{patient_id}:insulin:"
+        base_name = _base_name(patient_id, "insulin")
 
         senml_record = [
             {
@@ -130,12 +212,12 @@ class SenMLHelper:
             }
         ]
 
-        return json.dumps(senml_record)
+        return SenMLHelper.encode_senml(senml_record)
 
     @staticmethod
     def create_pump_status(patient_id: str, reservoir_level: float,
                            battery_level: float, status: str = "active",
-                           timestamp: float = None) -> str:
+                           timestamp: float = None) -> bytes:
         """
         Crea un messaggio SenML per lo status della pompa
 
@@ -147,12 +229,27 @@ class SenMLHelper:
             timestamp: Timestamp UNIX
 
         Returns:
-            Stringa JSON in formato SenML
+            Payload SenML (bytes, vedi encode_senml)
+        """
+        return SenMLHelper.encode_senml(
+            SenMLHelper.pump_status_records(patient_id, reservoir_level, battery_level, status, timestamp)
+        )
+
+    @staticmethod
+    def pump_status_records(patient_id: str, reservoir_level: float,
+                            battery_level: float, status: str = "active",
+                            timestamp: float = None) -> List[Dict[str, Any]]:
+        """
+        Crea i record SenML dello status della pompa senza serializzarli
+        (il chiamante può conservarli e aggiornarne i valori in place)
+
+        Returns:
+            Lista di record SenML
         """
         if timestamp is None:
             timestamp = time.time()
 
-        base_name = f"urn:patient:{patient_id}:pump:"
+        base_name = _base_name(patient_id, "pump")
 
         senml_record = [
             {
@@ -178,12 +275,12 @@ class SenMLHelper:
             }
         ]
 
-        return json.dumps(senml_record)
+        return senml_record
 
     @staticmethod
     def create_notification_alert(patient_id: str, alert_type: str,
                                   message: str, severity: str = "medium",
-                                  timestamp: float = None) -> str:
+                                  timestamp: float = None) -> bytes:
         """
         Crea un alert/notifica in formato SenML
 
@@ -195,14 +292,29 @@ class SenMLHelper:
             timestamp: Timestamp UNIX
 
         Returns:
-            Stringa JSON in formato SenML
+            Payload SenML (bytes, vedi encode_senml)
+        """
+        return SenMLHelper.encode_senml(
+            SenMLHelper.notification_alert_records(patient_id, alert_type, message, severity, timestamp)
+        )
+
+    @staticmethod
+    def notification_alert_records(patient_id: str, alert_type: str,
+                                   message: str, severity: str = "medium",
+                                   timestamp: float = None) -> List[Dict[str, Any]]:
+        """
+        Crea i record SenML di un alert senza serializzarli, così che più alert
+        possano essere concatenati in un unico pacchetto (vedi parse_senml_pack)
+
+        Returns:
+            Lista di record SenML
         """
         if timestamp is None:
             timestamp = time.time()
 
-        base_name = f"urn:patient:{patient_id}:alert:"
+        base_name = _base_name(patient_id, "alert")
 
-        senml_record = [
+        return [
             {
                 "bn": base_name,
                 "bt": timestamp
@@ -224,63 +336,176 @@ class SenMLHelper:
             }
         ]
 
-        return json.dumps(senml_record)
+    @staticmethod
+    def encode_senml(senml_record: List[Dict[str, Any]]) -> bytes:
+        """
+        Serializza un pacchetto SenML nel formato configurato
+
+        Args:
+            senml_record: Lista di record SenML con le chiavi testuali (bn, bt, n, v, ...)
+
+        Returns:
+            Bytes JSON UTF-8 (pronti per publish, senza ulteriore codifica), oppure
+            bytes SenML-CBOR se SENML_CBOR_ENABLED è attivo e cbor2 è installato
+        """
+        if Config.SENML_CBOR_ENABLED and cbor2 is not None:
+            return cbor2.dumps([
+                {SENML_CBOR_LABELS[key]: value for key, value in record.items()}
+                for record in senml_record
+            ])
+        return SenMLHelper.json_bytes(senml_record)
 
     @staticmethod
-    def parse_senml(senml_json: str) -> Dict[str, Any]:
+    def json_bytes(value: Any) -> bytes:
+        """
+        Serializza un valore JSON direttamente in bytes (orjson se disponibile)
+
+        Args:
+            value: Valore da serializzare (es. una stringa libera da inserire in un template)
+
+        Returns:
+            Bytes JSON UTF-8
+        """
+        if orjson is not None:
+            return orjson.dumps(value)
+        return json.dumps(value).encode()
+
+    @staticmethod
+    def enum_json(value: str) -> bytes:
+        """
+        Bytes JSON di un valore enumerato (gravità, modalità, priorità): i valori noti sono
+        pre-serializzati, gli altri passano da json_bytes e vengono comunque escapati
+        """
+        encoded = _ENUM_JSON.get(value)
+        return encoded if encoded is not None else SenMLHelper.json_bytes(value)
+
+    @staticmethod
+    def decode_senml(payload: Union[str, bytes]) -> List[Dict[str, Any]]:
+        """
+        Decodifica un payload SenML riconoscendo automaticamente JSON o CBOR
+
+        Un pacchetto SenML-CBOR è un array CBOR, quindi il primo byte ha major type 4
+        (0x80-0x9f); un pacchetto SenML-JSON inizia invece con '['.
+
+        Args:
+            payload: Payload ricevuto (str o bytes)
+
+        Returns:
+            Lista di record SenML con le chiavi testuali
+        """
+        if isinstance(payload, (bytes, bytearray)) and payload and 0x80 <= payload[0] <= 0x9f:
+            if cbor2 is None:
+                raise ValueError("Payload SenML-CBOR ricevuto ma cbor2 non è installato")
+            return [
+                {SENML_CBOR_NAMES.get(key, key): value for key, value in record.items()}
+                for record in cbor2.loads(payload)
+            ]
+        if orjson is not None:
+            return orjson.loads(payload)
+        # json.loads accetta direttamente i bytes UTF-8 del payload MQTT
+        return json.loads(payload)
+
+    @staticmethod
+    def _parse_records(records: List[Dict[str, Any]], base_name: str = "",
+                       base_unit: str = "", base_time: float = None) -> Dict[str, Any]:
+        """
+        Converte un gruppo di record nel dizionario parsato. I campi base arrivano dal
+        primo record o, se assenti, dal contesto del pacchetto (base_name/base_unit/base_time);
+        i record senza valore (es. il solo record base) non producono misure.
+        """
+        base_record = records[0]
+        measurements = {}
+        for record in records:
+            if "v" in record:  # Valore numerico
+                measurements[record.get("n", "")] = record["v"]
+            elif "vs" in record:  # Valore stringa
+                measurements[record.get("n", "")] = record["vs"]
+            elif "vb" in record:  # Valore booleano
+                measurements[record.get("n", "")] = record["vb"]
+
+        if "bt" in base_record:
+            base_time = base_record["bt"]
+        elif base_time is None:
+            base_time = time.time()
+
+        return {
+            "base_name": base_record.get("bn", base_name),
+            "base_time": base_time,
+            "base_unit": base_record.get("bu", base_unit),
+            "measurements": measurements
+        }
+
+    @staticmethod
+    def parse_senml(senml_json: Union[str, bytes]) -> Dict[str, Any]:
         """
         Parse un messaggio SenML e restituisce i dati in formato dizionario
 
         Args:
-            senml_json: Stringa JSON in formato SenML
+            senml_json: Payload SenML (JSON come str/bytes oppure CBOR come bytes)
 
         Returns:
-            Dizionario con i dati parsati
+            Dizionario con i dati parsati; "measurements" è una mappa piatta
+            nome -> valore (v, vs o vb del record)
         """
         try:
-            senml_data = json.loads(senml_json)
+            senml_data = SenMLHelper.decode_senml(senml_json)
 
             if not isinstance(senml_data, list) or len(senml_data) == 0:
                 raise ValueError("Invalid SenML format")
 
-            # Estrai base fields dal primo record
-            base_record = senml_data[0]
-            base_name = base_record.get("bn", "")
-            base_time = base_record.get("bt", time.time())
-            base_unit = base_record.get("bu", "")
-
-            parsed_data = {
-                "base_name": base_name,
-                "base_time": base_time,
-                "base_unit": base_unit,
-                "measurements": {}
-            }
+            return SenMLHelper._parse_records(senml_data)
+
+        except Exception as e:
+            raise ValueError(f"Error parsing SenML: {str(e)}")
+
+    @staticmethod
+    def parse_senml_pack(senml_json: Union[str, bytes]) -> List[Dict[str, Any]]:
+        """
+        Parse un pacchetto SenML che può contenere più messaggi concatenati
+
+        Ogni record che porta un campo base (bn o bt) apre un nuovo messaggio, così
+        come ogni record il cui tempo risolto (bt + t) differisce da quello del
+        messaggio corrente (letture in batch con offset relativi "t"); come da
+        RFC 8428 base name, base time e base unit restano validi per i messaggi
+        successivi finché non vengono ridefiniti.
+
+        Args:
+            senml_json: Payload SenML (JSON come str/bytes oppure CBOR come bytes)
+
+        Returns:
+            Lista di dizionari nello stesso formato di parse_senml
+        """
+        try:
+            senml_data = SenMLHelper.decode_senml(senml_json)
+
+            if not isinstance(senml_data, list) or len(senml_data) == 0:
+                raise ValueError("Invalid SenML format")
 
-            # Parse tutti i record di misurazione
-            for record in senml_data[1:]:  # Salta il primo record (base)
-                name = record.get("n", "")
-                time_offset = record.get("t", 0)
-
-                if "v" in record:  # Valore numerico
-                    parsed_data["measurements"][name] = {
-                        "value": record["v"],
-                        "timestamp": base_time + time_offset,
-                        "unit": record.get("u", base_unit)
-                    }
-                elif "vs" in record:  # Valore stringa
-                    parsed_data["measurements"][name] = {
-                        "value": record["vs"],
-                        "timestamp": base_time + time_offset,
-                        "type": "string"
-                    }
-
-            return parsed_data
+            groups = []  # (tempo risolto, record)
+            base_time = None
+            for record in senml_data:
+                if "bt" in record:
+                    base_time = record["bt"]
+                record_time = None if base_time is None else base_time + record.get("t", 0)
+                if (not groups or "bn" in record or "bt" in record
+                        or ("t" in record and record_time != groups[-1][0])):
+                    groups.append((record_time, [record]))
+                else:
+                    groups[-1][1].append(record)
+
+            messages = []
+            base_name, base_unit = "", ""
+            for record_time, group in groups:
+                parsed = SenMLHelper._parse_records(group, base_name, base_unit, record_time)
+                base_name, base_unit = parsed["base_name"], parsed["base_unit"]
+                messages.append(parsed)
+            return messages
 
         except Exception as e:
             raise ValueError(f"Error parsing SenML: {str(e)}")
 
     @staticmethod
-    def validate_senml(senml_json: str) -> bool:
+    def validate_senml(senml_json: Union[str, bytes]) -> bool:
         """
         Valida se una stringa JSON è un formato SenML valido
 
@@ -290,8 +515,11 @@ class SenMLHelper:
         Returns:
             True se valido, False altrimenti
         """
+        # Solo decodifica e controllo della forma, senza costruire il dizionario di parse_senml
         try:
-            SenMLHelper.parse_senml(senml_json)
-            return True
-        except:
-            return False
\ No newline at end of file
+            senml_data = SenMLHelper.decode_senml(senml_json)
+        except Exception:
+            return False
+        # Stessa regola di parse_senml: lista non vuota di soli record oggetto
+        return (isinstance(senml_data, list) and len(senml_data) > 0
+                and all(isinstance(record, dict) for record in senml_data))
\ No newline at end of file